@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 """
-S3から音声ファイルをダウンロードして分析するスクリプト
+S3から音声ファイルを取得して分析するスクリプト
 """
 
 import os
 import sys
-import tempfile
 import boto3
+from botocore.config import Config
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 # 環境変数を読み込み
 load_dotenv()
@@ -24,67 +27,69 @@ if not aws_access_key_id or not aws_secret_access_key:
     print("❌ AWS認証情報が設定されていません。.envファイルを確認してください。")
     sys.exit(1)
 
+# 複数リクエストで接続を使い回せるよう接続プールを拡張
 s3_client = boto3.client(
     's3',
     aws_access_key_id=aws_access_key_id,
     aws_secret_access_key=aws_secret_access_key,
-    region_name=aws_region
+    region_name=aws_region,
+    config=Config(
+        max_pool_connections=32,
+        retries={'max_attempts': 5, 'mode': 'adaptive'},
+        tcp_keepalive=True
+    )
 )
 
-def download_from_s3(s3_path: str) -> str:
+# S3からAPIへ転送する際のチャンクサイズ（1MB）
+STREAM_CHUNK_SIZE = 1 << 20
+
+# スコア表示用のバー（表示時はスライスして使う）
+BAR_WIDTH = 30
+FULL_BAR = "█" * BAR_WIDTH
+
+# APIへのHTTPセッション（keep-aliveで接続を使い回す）
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+))
+
+def stream_analyze(s3_path: str, api_url: str = "http://localhost:8017"):
     """
-    S3から音声ファイルをダウンロード
+    S3の音声ファイルを一時ファイルを経由せずにAPIへストリーミングして分析
     
     Args:
         s3_path: S3のファイルパス (例: files/device_id/date/time/audio.wav)
+        api_url: APIサーバーのURL
     
     Returns:
-        ダウンロードしたローカルファイルのパス
+        分析結果
     """
-    print(f"📥 S3からダウンロード中: {s3_path}")
-    
-    # 一時ファイルを作成
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-        local_path = tmp_file.name
+    print(f"📥 S3からストリーミング中: {s3_path}")
     
     try:
-        # S3からダウンロード
-        s3_client.download_file(s3_bucket_name, s3_path, local_path)
-        print(f"✅ ダウンロード完了: {local_path}")
-        
-        # ファイルサイズを確認
-        file_size = os.path.getsize(local_path)
-        print(f"   ファイルサイズ: {file_size / 1024:.1f} KB")
-        
-        return local_path
-        
+        s3_object = s3_client.get_object(Bucket=s3_bucket_name, Key=s3_path)
     except Exception as e:
         print(f"❌ ダウンロードエラー: {str(e)}")
-        if os.path.exists(local_path):
-            os.remove(local_path)
-        raise
-
-def analyze_audio(file_path: str, api_url: str = "http://localhost:8017"):
-    """
-    ASTのAPIを使用して音声ファイルを分析
+        return None
     
-    Args:
-        file_path: 分析する音声ファイルのパス
-        api_url: APIサーバーのURL
+    body = s3_object['Body']
+    print(f"   ファイルサイズ: {s3_object['ContentLength'] / 1024:.1f} KB")
     
-    Returns:
-        分析結果
-    """
     print(f"\n🔬 音声ファイルを分析中...")
     
-    # APIエンドポイント
-    endpoint = f"{api_url}/analyze_sound"
+    # APIエンドポイント（マルチパートを使わないraw body版）
+    endpoint = f"{api_url}/analyze_sound_raw"
     
     try:
-        # ファイルをアップロード
-        with open(file_path, 'rb') as f:
-            files = {'file': ('audio.wav', f, 'audio/wav')}
-            response = requests.post(endpoint, files=files)
+        # S3のレスポンスボディをそのままAPIへ転送
+        response = SESSION.post(
+            endpoint,
+            data=body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE),
+            headers={'Content-Type': 'audio/wav'},
+            params={'filename': os.path.basename(s3_path)}
+        )
         
         if response.status_code == 200:
             result = response.json()
@@ -101,70 +106,92 @@ def analyze_audio(file_path: str, api_url: str = "http://localhost:8017"):
     except Exception as e:
         print(f"❌ 分析エラー: {str(e)}")
         return None
+    finally:
+        body.close()
+
+def display_result(result: dict):
+    """分析結果を見やすく表示"""
+    
+    print("\n" + "=" * 60)
+    print("📊 分析結果")
+    print("=" * 60)
+    
+    # 音声情報
+    if 'audio_info' in result:
+        info = result['audio_info']
+        print(f"\n🎵 音声情報:")
+        print(f"   - ファイル名: {info.get('filename', 'N/A')}")
+        print(f"   - 長さ: {info.get('duration_seconds', 0):.1f}秒")
+        print(f"   - サンプリングレート: {info.get('sample_rate', 0)} Hz")
+    
+    # 予測結果
+    if 'predictions' in result:
+        print(f"\n🎯 検出された音響イベント (上位5件):")
+        print("-" * 40)
+        for i, pred in enumerate(result['predictions'], 1):
+            label = pred['label']
+            score = pred['score']
+            bar = FULL_BAR[:int(score * BAR_WIDTH)]
+            print(f"  {i}. {label:<30} {score:.4f} {bar}")
+
+def output_path(filename: str, s3_path: str, multiple: bool) -> str:
+    """
+    保存先ファイル名を決定（複数ファイル処理時はS3パスで区別する）
+    
+    Args:
+        filename: 基本のファイル名
+        s3_path: S3のファイルパス
+        multiple: 複数ファイルを処理しているか
+    
+    Returns:
+        保存先ファイル名
+    """
+    if not multiple:
+        return filename
+    stem, ext = os.path.splitext(filename)
+    suffix = os.path.dirname(s3_path).replace('/', '_')
+    return f"{stem}_{suffix}{ext}"
 
 def main():
     """メイン処理"""
     
-    # 分析対象のS3パス
-    s3_path = "files/d067d407-cf73-4174-a9c1-d91fb60d64d0/2025-09-18/17-00/audio.wav"
+    # 分析対象のS3パス（コマンドライン引数で複数指定可能）
+    s3_paths = sys.argv[1:] or [
+        "files/d067d407-cf73-4174-a9c1-d91fb60d64d0/2025-09-18/17-00/audio.wav"
+    ]
+    max_workers = int(os.getenv('WORKERS', 16))
     
     print("=" * 60)
     print("AST音響イベント検出 - S3ファイル分析")
     print("=" * 60)
-    print(f"対象ファイル: {s3_path}")
+    print(f"対象ファイル数: {len(s3_paths)} (並列数: {max_workers})")
+    for s3_path in s3_paths:
+        print(f"   - {s3_path}")
     print()
     
     try:
-        # 1. S3からダウンロード
-        local_file = download_from_s3(s3_path)
+        # 1. S3からAPIへストリーミングして並列に分析
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(stream_analyze, s3_paths))
         
-        # 2. APIで分析
-        result = analyze_audio(local_file)
-        
-        if result:
-            # 3. 結果を表示
-            print("\n" + "=" * 60)
-            print("📊 分析結果")
-            print("=" * 60)
-            
-            # 音声情報
-            if 'audio_info' in result:
-                info = result['audio_info']
-                print(f"\n🎵 音声情報:")
-                print(f"   - ファイル名: {info.get('filename', 'N/A')}")
-                print(f"   - 長さ: {info.get('duration_seconds', 0):.1f}秒")
-                print(f"   - サンプリングレート: {info.get('sample_rate', 0)} Hz")
+        for s3_path, result in zip(s3_paths, results):
+            if not result:
+                continue
             
-            # 予測結果
-            if 'predictions' in result:
-                print(f"\n🎯 検出された音響イベント (上位5件):")
-                print("-" * 40)
-                for i, pred in enumerate(result['predictions'], 1):
-                    label = pred['label']
-                    score = pred['score']
-                    bar = "█" * int(score * 30)
-                    print(f"  {i}. {label:<30} {score:.4f} {bar}")
+            # 2. 結果を表示
+            print(f"\n対象ファイル: {s3_path}")
+            display_result(result)
             
             # JSON形式でも保存
-            output_file = "analysis_result.json"
+            output_file = output_path("analysis_result.json", s3_path, len(s3_paths) > 1)
             with open(output_file, 'w') as f:
                 json.dump(result, f, indent=2)
             print(f"\n💾 結果を保存しました: {output_file}")
             
-        # 4. 一時ファイルを削除
-        if os.path.exists(local_file):
-            os.remove(local_file)
-            print(f"\n🗑️  一時ファイルを削除しました")
-            
     except Exception as e:
         print(f"\n❌ エラーが発生しました: {str(e)}")
         import traceback
         traceback.print_exc()
 
 if __name__ == "__main__":
-    # コマンドライン引数でS3パスを指定できるようにする
-    if len(sys.argv) > 1:
-        s3_path = sys.argv[1]
-        print(f"指定されたパス: {s3_path}")
-    
-    main()
\ No newline at end of file
+    main()
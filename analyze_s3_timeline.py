@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 """
-S3から音声ファイルをダウンロードして時系列分析するスクリプト
+S3から音声ファイルを取得して時系列分析するスクリプト
 """
 
 import os
 import sys
-import tempfile
 import boto3
+from botocore.config import Config
 from dotenv import load_dotenv
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 
 # 環境変数を読み込み
 load_dotenv()
@@ -24,67 +27,77 @@ if not aws_access_key_id or not aws_secret_access_key:
     print("❌ AWS認証情報が設定されていません。.envファイルを確認してください。")
     sys.exit(1)
 
+# 複数リクエストで接続を使い回せるよう接続プールを拡張
 s3_client = boto3.client(
     's3',
     aws_access_key_id=aws_access_key_id,
     aws_secret_access_key=aws_secret_access_key,
-    region_name=aws_region
+    region_name=aws_region,
+    config=Config(
+        max_pool_connections=32,
+        retries={'max_attempts': 5, 'mode': 'adaptive'},
+        tcp_keepalive=True
+    )
 )
 
-def download_from_s3(s3_path: str) -> str:
-    """S3から音声ファイルをダウンロード"""
-    print(f"📥 S3からダウンロード中: {s3_path}")
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-        local_path = tmp_file.name
-    
-    try:
-        s3_client.download_file(s3_bucket_name, s3_path, local_path)
-        print(f"✅ ダウンロード完了: {local_path}")
-        
-        file_size = os.path.getsize(local_path)
-        print(f"   ファイルサイズ: {file_size / 1024:.1f} KB")
-        
-        return local_path
-        
-    except Exception as e:
-        print(f"❌ ダウンロードエラー: {str(e)}")
-        if os.path.exists(local_path):
-            os.remove(local_path)
-        raise
+# S3からAPIへ転送する際のチャンクサイズ（1MB）
+STREAM_CHUNK_SIZE = 1 << 20
+
+# APIへのHTTPセッション（keep-aliveで接続を使い回す）
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+))
 
-def analyze_timeline(file_path: str, api_url: str = "http://localhost:8017"):
+def stream_analyze(s3_path: str, api_url: str = "http://localhost:8017"):
     """
-    ASTのAPIを使用して音声ファイルを時系列分析
+    S3の音声ファイルを一時ファイルを経由せずにAPIへストリーミングして時系列分析
     
     Args:
-        file_path: 分析する音声ファイルのパス
+        s3_path: S3のファイルパス
         api_url: APIサーバーのURL
     
     Returns:
         分析結果
     """
+    print(f"📥 S3からストリーミング中: {s3_path}")
+    
+    try:
+        s3_object = s3_client.get_object(Bucket=s3_bucket_name, Key=s3_path)
+    except Exception as e:
+        print(f"❌ ダウンロードエラー: {str(e)}")
+        return None
+    
+    body = s3_object['Body']
+    print(f"   ファイルサイズ: {s3_object['ContentLength'] / 1024:.1f} KB")
+    
     print(f"\n🔬 音声ファイルを時系列分析中...")
-    print(f"   設定: 1秒ごと、50%オーバーラップ、上位3イベント")
+    print(f"   設定: 10秒ごと、オーバーラップなし、上位3イベント")
     
-    # APIエンドポイント
-    endpoint = f"{api_url}/analyze_timeline"
+    # APIエンドポイント（マルチパートを使わないraw body版）
+    endpoint = f"{api_url}/analyze_timeline_raw"
     
     try:
         # パラメータ設定
         params = {
-            "segment_duration": 1.0,  # 1秒ごと
-            "overlap": 0.5,           # 50%オーバーラップ
-            "top_k": 3                # 上位3イベント
+            "segment_duration": 10.0, # 10秒ごと（ASTの入力長）
+            "overlap": 0.0,           # オーバーラップなし
+            "top_k": 3,               # 上位3イベント
+            "filename": os.path.basename(s3_path)
         }
         
-        # ファイルをアップロード
-        with open(file_path, 'rb') as f:
-            files = {'file': ('audio.wav', f, 'audio/wav')}
-            response = requests.post(endpoint, files=files, params=params)
+        # S3のレスポンスボディをそのままAPIへ転送
+        response = SESSION.post(
+            endpoint,
+            data=body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE),
+            headers={'Content-Type': 'audio/wav', 'Accept-Encoding': 'gzip'},
+            params=params
+        )
         
         if response.status_code == 200:
-            result = response.json()
+            result = orjson.loads(response.content)
             return result
         else:
             print(f"❌ API エラー: {response.status_code}")
@@ -98,6 +111,8 @@ def analyze_timeline(file_path: str, api_url: str = "http://localhost:8017"):
     except Exception as e:
         print(f"❌ 分析エラー: {str(e)}")
         return None
+    finally:
+        body.close()
 
 def display_timeline(result: dict):
     """時系列結果を見やすく表示"""
@@ -130,15 +145,19 @@ def display_timeline(result: dict):
                 avg_score = event['average_score']
                 print(f"   {i}. {label:<25} 出現: {count:3}回, 平均スコア: {avg_score:.3f}")
     
-    # タイムライン（最初の20秒分を表示）
+    # タイムライン（最初の60秒分を表示）
     if 'timeline' in result:
         timeline = result['timeline']
-        print(f"\n⏱️  時系列イベント (最初の20秒):")
+        print(f"\n⏱️  時系列イベント (最初の60秒):")
         print("-" * 70)
         print(f"{'時刻':>5} | {'イベント1':<20} | {'イベント2':<20} | {'イベント3':<20}")
         print("-" * 70)
         
-        for segment in timeline[:40]:  # 最初の20秒（0.5秒刻みで40セグメント）
+        for segment in timeline:
+            # 最初の60秒（10秒刻みで6セグメント）
+            if segment['time'] >= 60:
+                break
+            
             time_str = f"{segment['time']:.1f}s"
             events = segment['events']
             
@@ -162,63 +181,81 @@ def save_timeline_csv(result: dict, output_file: str = "timeline.csv"):
     if 'timeline' not in result:
         return
     
+    # 各セグメントを7列の行に変換（不足分は空文字で埋める）
+    empty_event = {'label': '', 'score': ''}
+    rows = []
+    for segment in result['timeline']:
+        events = (segment['events'][:3] + [empty_event] * 3)[:3]
+        rows.append([segment['time']] + [value for event in events for value in (event['label'], event['score'])])
+    
     with open(output_file, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
         
         # ヘッダー
         writer.writerow(['Time(s)', 'Event1', 'Score1', 'Event2', 'Score2', 'Event3', 'Score3'])
         
-        # データ
-        for segment in result['timeline']:
-            row = [segment['time']]
-            for event in segment['events'][:3]:
-                row.extend([event['label'], event['score']])
-            # 不足分を埋める
-            while len(row) < 7:
-                row.extend(['', ''])
-            writer.writerow(row)
+        # データ（writerowsで一括書き込み）
+        writer.writerows(rows)
     
     print(f"\n💾 CSVファイルに保存しました: {output_file}")
 
+def output_path(filename: str, s3_path: str, multiple: bool) -> str:
+    """
+    保存先ファイル名を決定（複数ファイル処理時はS3パスで区別する）
+    
+    Args:
+        filename: 基本のファイル名
+        s3_path: S3のファイルパス
+        multiple: 複数ファイルを処理しているか
+    
+    Returns:
+        保存先ファイル名
+    """
+    if not multiple:
+        return filename
+    stem, ext = os.path.splitext(filename)
+    suffix = os.path.dirname(s3_path).replace('/', '_')
+    return f"{stem}_{suffix}{ext}"
+
 def main():
     """メイン処理"""
     
-    # 分析対象のS3パス
-    if len(sys.argv) > 1:
-        s3_path = sys.argv[1]
-    else:
-        s3_path = "files/d067d407-cf73-4174-a9c1-d91fb60d64d0/2025-09-18/17-00/audio.wav"
+    # 分析対象のS3パス（コマンドライン引数で複数指定可能）
+    s3_paths = sys.argv[1:] or [
+        "files/d067d407-cf73-4174-a9c1-d91fb60d64d0/2025-09-18/17-00/audio.wav"
+    ]
+    max_workers = int(os.getenv('WORKERS', 16))
+    multiple = len(s3_paths) > 1
     
     print("=" * 70)
     print("AST音響イベント検出 - 時系列分析")
     print("=" * 70)
-    print(f"対象ファイル: {s3_path}")
+    print(f"対象ファイル数: {len(s3_paths)} (並列数: {max_workers})")
+    for s3_path in s3_paths:
+        print(f"   - {s3_path}")
     print()
     
     try:
-        # 1. S3からダウンロード
-        local_file = download_from_s3(s3_path)
+        # 1. S3からAPIへストリーミングして並列に時系列分析
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(stream_analyze, s3_paths))
         
-        # 2. APIで時系列分析
-        result = analyze_timeline(local_file)
-        
-        if result:
-            # 3. 結果を表示
+        for s3_path, result in zip(s3_paths, results):
+            if not result:
+                continue
+            
+            # 2. 結果を表示
+            print(f"\n対象ファイル: {s3_path}")
             display_timeline(result)
             
-            # 4. JSONで保存
-            output_json = "timeline_result.json"
-            with open(output_json, 'w') as f:
-                json.dump(result, f, indent=2)
+            # 3. JSONで保存
+            output_json = output_path("timeline_result.json", s3_path, multiple)
+            with open(output_json, 'wb') as f:
+                f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
             print(f"\n💾 JSON結果を保存しました: {output_json}")
             
-            # 5. CSVでも保存
-            save_timeline_csv(result)
-            
-        # 6. 一時ファイルを削除
-        if os.path.exists(local_file):
-            os.remove(local_file)
-            print(f"\n🗑️  一時ファイルを削除しました")
+            # 4. CSVでも保存
+            save_timeline_csv(result, output_path("timeline.csv", s3_path, multiple))
             
     except Exception as e:
         print(f"\n❌ エラーが発生しました: {str(e)}")
@@ -226,4 +263,4 @@ def main():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""
+AST (Audio Spectrogram Transformer) 推論の共通処理
+main_timeline.py / main_supabase.py / test_model.py から使用する
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple
+
+import torch
+import torchaudio
+import torchaudio.compliance.kaldi as ta_kaldi
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from transformers import AutoFeatureExtractor, ASTForAudioClassification
+
+# グローバル変数でモデルを保持（load_modelで作成）
+model = None
+feature_extractor = None
+id2label = None
+LABELS = None  # クラスID順のラベル名リスト
+compiled = False  # torch.compileが有効か（compile_modelで設定）
+
+# モデル名
+MODEL_NAME = "MIT/ast-finetuned-audioset-10-10-0.4593"
+
+# モデルが期待するサンプリングレート（MODEL_NAMEのfeature extractorに合わせる）
+TARGET_SR = 16000
+
+# CPUでbfloat16の行列演算（AMX）が使えるか
+CPU_BF16_SUPPORTED = getattr(torch.cpu, "_is_amx_tile_supported", lambda: False)()
+
+# このRMS未満のセグメントは推論せずに無音（Silence）として扱う
+SILENCE_RMS_THRESHOLD = float(os.getenv('SILENCE_RMS_THRESHOLD', 1e-3))
+
+# 1回の推論でまとめて処理するセグメント数（メモリ使用量の上限）
+SEGMENT_BATCH_SIZE = int(os.getenv('SEGMENT_BATCH_SIZE', 8))
+
+# ビルド時に事前ダウンロードしたモデルの保存先（存在すればHugging Faceに接続せずにロード）
+MODEL_PATH = os.getenv('AST_MODEL_PATH', '/models/ast')
+
+# torch.compile(mode="reduce-overhead")のCUDA Graphは記録したスレッドでしか再利用されないため、
+# ウォームアップを含むモデルの推論はすべてこの1スレッドで実行する
+_inference_local = threading.local()
+
+def _mark_inference_thread():
+    _inference_local.active = True
+
+inference_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="inference", initializer=_mark_inference_thread
+)
+
+def run_on_inference_thread(func, *args, **kwargs):
+    """
+    関数を推論専用スレッドで実行して結果を待つ（推論専用スレッドからの呼び出しはそのまま実行）
+    
+    Args:
+        func: 実行する関数
+        *args, **kwargs: 関数の引数
+    
+    Returns:
+        関数の戻り値
+    """
+    if getattr(_inference_local, "active", False):
+        return func(*args, **kwargs)
+    return inference_executor.submit(func, *args, **kwargs).result()
+
+def load_model():
+    """モデルとfeature extractorを読み込む"""
+    global model, feature_extractor, id2label, LABELS
+    
+    print(f"🔄 モデルをロード中: {MODEL_NAME}")
+    try:
+        # ローカルのスナップショットがあればそちらを優先
+        local_files_only = os.path.isdir(MODEL_PATH)
+        model_source = MODEL_PATH if local_files_only else MODEL_NAME
+        feature_extractor = AutoFeatureExtractor.from_pretrained(
+            model_source, local_files_only=local_files_only
+        )
+        model = ASTForAudioClassification.from_pretrained(
+            model_source, local_files_only=local_files_only
+        )
+        
+        # ラベルマッピングを取得
+        id2label = model.config.id2label
+        
+        # クラスIDをそのまま添字にできるラベル名リストを作成（予測ごとの辞書引きをなくす）
+        LABELS = [
+            id2label.get(i) or id2label.get(str(i)) or f"Event_{i}"
+            for i in range(model.config.num_labels)
+        ]
+        
+        # 全クラスにラベル名があることを起動時に1回だけ確認
+        missing_labels = [label for label in LABELS if label.startswith("Event_")]
+        if missing_labels:
+            print(f"⚠️ id2labelにラベル名がないクラスがあります: {len(missing_labels)}件")
+        
+        # GPUがあればGPUで実行
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model.to(device)
+        model.eval()
+        
+        print(f"✅ モデルのロードに成功しました")
+        print(f"   - デバイス: {device}")
+        print(f"   - ラベル数: {len(id2label)}")
+        
+        # 推論1回あたりのオーバーヘッドを減らすためにコンパイル
+        compile_model()
+        
+    except Exception as e:
+        print(f"❌ モデルのロードに失敗しました: {str(e)}")
+        raise
+
+def compile_model():
+    """
+    torch.compileでモデルをコンパイルし、ダミー入力でウォームアップする
+    （失敗した場合はeagerモードのまま使用）
+    """
+    global model, compiled
+    
+    eager_model = model
+    try:
+        model = torch.compile(eager_model, mode="reduce-overhead", fullgraph=False)
+        compiled = True
+        
+        # 最初のリクエストより前に、実際に使うバッチサイズ（SEGMENT_BATCH_SIZE）で
+        # コンパイルとCUDA Graphの記録を済ませる（GPUでは端数のバッチもこのサイズにパディングされる）
+        dummy_audio = np.zeros(TARGET_SR, dtype=np.float32)
+        for _ in range(3):
+            predict_segments([dummy_audio] * SEGMENT_BATCH_SIZE, top_k=1)
+        print(f"   - torch.compile: 有効（バッチサイズ: {SEGMENT_BATCH_SIZE}）")
+    except Exception as e:
+        model = eager_model
+        compiled = False
+        print(f"⚠️ torch.compileに失敗したためeagerモードで実行します: {str(e)}")
+
+# リサンプラーのキャッシュ（元のサンプリングレートごとに1つ作成）
+_resamplers = {}
+
+def resample_audio(audio_data: np.ndarray, orig_sr: int, target_sr: int) -> np.ndarray:
+    """
+    torchaudioのポリフェーズリサンプラーでリサンプリング（GPUがあればGPUで実行）
+    
+    Args:
+        audio_data: 音声データ（numpy配列）
+        orig_sr: 元のサンプリングレート
+        target_sr: 変換後のサンプリングレート
+    
+    Returns:
+        リサンプリング後の音声データ
+    """
+    device = next(model.parameters()).device
+    key = (orig_sr, target_sr)
+    if key not in _resamplers:
+        # librosaのkaiser_bestと同等のパラメータ
+        _resamplers[key] = torchaudio.transforms.Resample(
+            orig_freq=orig_sr,
+            new_freq=target_sr,
+            resampling_method="sinc_interp_kaiser",
+            lowpass_filter_width=64,
+            rolloff=0.9475937167399596,
+            beta=14.769656459379492
+        ).to(device)
+    
+    waveform = torch.from_numpy(np.ascontiguousarray(audio_data, dtype=np.float32)).to(device)
+    return _resamplers[key](waveform).cpu().numpy()
+
+def normalize_audio(audio_data: np.ndarray) -> np.ndarray:
+    """
+    ピーク値で正規化（-1.0 〜 1.0）
+    
+    Args:
+        audio_data: 音声データ（float配列、上書きされる）
+    
+    Returns:
+        正規化済みの音声データ
+    """
+    # abs配列を作らずにピーク値を求める
+    max_val = max(audio_data.max(), -audio_data.min()) if audio_data.size else 0.0
+    
+    # 既にほぼ正規化済みなら何もしない
+    if max_val > 0 and not (0.99 <= max_val <= 1.01):
+        np.multiply(audio_data, 1.0 / max_val, out=audio_data)
+    
+    return audio_data
+
+def process_audio(audio_data: np.ndarray, sample_rate: int) -> np.ndarray:
+    """
+    音声データを前処理する（モノラル化・16kHzへのリサンプリング・正規化）
+    
+    Args:
+        audio_data: 音声データ（numpy配列）
+        sample_rate: サンプリングレート
+    
+    Returns:
+        処理済みの音声データ
+    """
+    # モノラルに変換
+    if len(audio_data.shape) > 1:
+        audio_data = audio_data.mean(axis=1, dtype=np.float32)
+    
+    # モデルが期待するサンプリングレートにリサンプリング（16kHz）
+    if sample_rate != TARGET_SR:
+        audio_data = resample_audio(audio_data, sample_rate, TARGET_SR)
+    
+    # 正規化（-1.0 〜 1.0）
+    return normalize_audio(audio_data)
+
+def extract_features(feature_extractor, audio_segments, device) -> torch.Tensor:
+    """
+    Kaldi互換のfbank特徴量を指定したデバイス上で計算（ASTFeatureExtractorと同じ処理）
+    
+    Args:
+        feature_extractor: パラメータ（メル数・フレーム数・平均・標準偏差）を参照するfeature extractor
+        audio_segments: 前処理済みの音声セグメント（numpy配列のリスト、または [B, num_samples] のテンソル）
+        device: 計算に使用するデバイス
+    
+    Returns:
+        [B, max_length, num_mel_bins] のinput_values
+    """
+    max_length = feature_extractor.max_length
+    features = []
+    for segment in audio_segments:
+        if isinstance(segment, np.ndarray):
+            segment = torch.from_numpy(np.ascontiguousarray(segment, dtype=np.float32))
+        waveform = segment.to(device, dtype=torch.float32)
+        fbank = ta_kaldi.fbank(
+            waveform.unsqueeze(0),
+            sample_frequency=feature_extractor.sampling_rate,
+            htk_compat=True,
+            use_energy=False,
+            window_type="hanning",
+            num_mel_bins=feature_extractor.num_mel_bins,
+            dither=0.0,
+            frame_shift=10
+        )
+        
+        # max_lengthフレームにパディング/切り詰め
+        n_frames = fbank.shape[0]
+        if n_frames < max_length:
+            fbank = torch.nn.functional.pad(fbank, (0, 0, 0, max_length - n_frames))
+        else:
+            fbank = fbank[:max_length]
+        features.append(fbank)
+    
+    input_values = torch.stack(features)
+    
+    # feature extractorに保存された平均・標準偏差で正規化
+    if feature_extractor.do_normalize:
+        input_values = (input_values - feature_extractor.mean) / (feature_extractor.std * 2)
+    
+    return input_values
+
+def predict_segments(audio_segments: List[np.ndarray], top_k: int = 5,
+                     threshold: float = 0.0) -> List[List[Dict]]:
+    """
+    複数の音声セグメントをSEGMENT_BATCH_SIZE件ずつまとめて推論専用スレッドで予測
+    
+    Args:
+        audio_segments: 前処理済みの音声セグメントのリスト
+        top_k: 各セグメントで返す上位予測の数
+        threshold: 最小確率しきい値（0.0なら上位k個をすべて返す）
+    
+    Returns:
+        セグメントごとの予測結果のリスト
+    """
+    results = []
+    for batch_start in range(0, len(audio_segments), SEGMENT_BATCH_SIZE):
+        batch = audio_segments[batch_start:batch_start + SEGMENT_BATCH_SIZE]
+        results.extend(run_on_inference_thread(_predict_batch, batch, top_k, threshold))
+    return results
+
+def _predict_batch(audio_segments: List[np.ndarray], top_k: int,
+                   threshold: float) -> List[List[Dict]]:
+    """
+    SEGMENT_BATCH_SIZE件以下の音声セグメントを1回の推論で予測（推論専用スレッドで実行）
+    
+    Args:
+        audio_segments: 前処理済みの音声セグメントのリスト
+        top_k: 各セグメントで返す上位予測の数
+        threshold: 最小確率しきい値
+    
+    Returns:
+        セグメントごとの予測結果のリスト
+    """
+    # 特徴抽出（全セグメントをモデルと同じデバイス上で計算）
+    device = next(model.parameters()).device
+    input_values = extract_features(feature_extractor, audio_segments, device)
+    
+    # GPUではコンパイル済みのモデルの入力形状が変わるとCUDA Graphの再記録が走るため、
+    # 端数のバッチはゼロの特徴量でSEGMENT_BATCH_SIZEにパディングし、その分の出力は捨てる
+    # （CPUではCUDA Graphを使わないので、パディングせずに実際のセグメント数だけ計算する）
+    num_segments = input_values.shape[0]
+    if compiled and device.type == "cuda" and num_segments < SEGMENT_BATCH_SIZE:
+        input_values = torch.nn.functional.pad(
+            input_values, (0, 0, 0, 0, 0, SEGMENT_BATCH_SIZE - num_segments)
+        )
+    inputs = {"input_values": input_values}
+    
+    # 推論実行（GPUはfloat16、対応CPUはbfloat16の自動混合精度）
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type,
+        dtype=torch.float16 if device.type == "cuda" else torch.bfloat16,
+        enabled=device.type == "cuda" or CPU_BF16_SUPPORTED
+    ):
+        outputs = model(**inputs)
+        logits = outputs.logits[:num_segments].float()
+    
+    # Softmaxで確率に変換
+    probs = torch.nn.functional.softmax(logits, dim=-1)
+    
+    # 各セグメントの上位k個としきい値判定をまとめて計算
+    top_probs, top_indices = torch.topk(probs, min(top_k, probs.shape[-1]), dim=-1)
+    mask = top_probs >= threshold
+    
+    # しきい値以上の要素だけをデバイス上で取り出してCPUに転送
+    # （行優先で平坦化されるので、行ごとの件数で元のセグメントに分け直す）
+    kept_probs = top_probs[mask].cpu().numpy()
+    kept_indices = top_indices[mask].cpu().numpy()
+    kept_counts = mask.sum(dim=-1).cpu().numpy()
+    
+    # 結果を整形（しきい値以上のみ）
+    offsets = np.concatenate(([0], np.cumsum(kept_counts))).tolist()
+    scores = kept_probs.tolist()
+    label_ids = kept_indices.tolist()
+    results = [
+        [
+            {"label": LABELS[label_id], "score": round(score, 4)}
+            for score, label_id in zip(scores[start:end], label_ids[start:end])
+        ]
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+    
+    return results
+
+def split_segments(audio_data: np.ndarray, segment_samples: int, hop_samples: int,
+                   keep_short_audio: bool = False) -> Tuple[np.ndarray, List[int]]:
+    """
+    音声をスライディングウィンドウでセグメントに分割（コピーせずにビューを作成）
+    
+    Args:
+        audio_data: 前処理済みの音声データ
+        segment_samples: セグメントのサンプル数
+        hop_samples: セグメントの開始位置の間隔（サンプル数）
+        keep_short_audio: セグメントより短い音声を全体で1セグメントとして扱うか
+            （Falseならセグメントなし）
+    
+    Returns:
+        ([セグメント数, サンプル数] のセグメント, 各セグメントの開始位置のリスト)
+    """
+    if len(audio_data) >= segment_samples:
+        segments = sliding_window_view(audio_data, segment_samples)[::hop_samples]
+    elif keep_short_audio:
+        segments = audio_data[np.newaxis, :]
+    else:
+        segments = np.empty((0, segment_samples), dtype=audio_data.dtype)
+    start_indices = (np.arange(len(segments)) * hop_samples).tolist()
+    return segments, start_indices
+
+def predict_timeline_segments(segments: np.ndarray, top_k: int = 3,
+                              threshold: float = 0.0) -> List[List[Dict]]:
+    """
+    無音のセグメントを除き、SEGMENT_BATCH_SIZE件ずつまとめて推論
+    
+    Args:
+        segments: [セグメント数, サンプル数] のセグメント
+        top_k: 各セグメントで返す上位予測の数
+        threshold: 最小確率しきい値
+    
+    Returns:
+        セグメントごとの予測結果のリスト（無音のセグメントはSilence）
+    """
+    # RMSが小さいセグメントは推論せずに無音とする（二乗の一時配列を作らずに計算）
+    rms = np.sqrt(np.einsum('ij,ij->i', segments, segments) / max(segments.shape[1], 1))
+    silent = rms < SILENCE_RMS_THRESHOLD
+    segment_events = [[{"label": "Silence", "score": 1.0}] if is_silent else None
+                      for is_silent in silent.tolist()]
+    
+    # 無音以外のセグメントだけをバッチ単位でまとめて推論
+    active_indices = np.flatnonzero(~silent)
+    for batch_start in range(0, len(active_indices), SEGMENT_BATCH_SIZE):
+        batch_indices = active_indices[batch_start:batch_start + SEGMENT_BATCH_SIZE]
+        batch_events = predict_segments(list(segments[batch_indices]), top_k, threshold)
+        for index, events in zip(batch_indices.tolist(), batch_events):
+            segment_events[index] = events
+    
+    return segment_events
+
+def summarize_events(segment_events: List[List[Dict]], limit: int = 5) -> List[Dict]:
+    """
+    全セグメントのイベントを集計し、出現回数の多い順に返す
+    
+    Args:
+        segment_events: セグメントごとの予測結果のリスト
+        limit: 返すイベントの数
+    
+    Returns:
+        出現回数と平均スコアを含むイベントのリスト
+    """
+    labels = [event["label"] for events in segment_events for event in events]
+    if not labels:
+        return []
+    scores = np.fromiter(
+        (event["score"] for events in segment_events for event in events),
+        dtype=np.float64, count=len(labels)
+    )
+    
+    # ラベルごとに出現回数とスコア合計をまとめて集計
+    unique_labels, first_index, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    counts = np.bincount(inverse)
+    score_sums = np.bincount(inverse, weights=scores)
+    
+    # 出現回数の降順（同数なら先に出現した順）で上位を取得
+    order = np.lexsort((first_index, -counts))[:limit]
+    
+    return [
+        {
+            "label": str(unique_labels[i]),
+            "occurrences": int(counts[i]),
+            "average_score": round(float(score_sums[i] / counts[i]), 4)
+        }
+        for i in order
+    ]
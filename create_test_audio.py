@@ -14,36 +14,35 @@ def create_test_audio():
     # サンプリングレート
     sample_rate = 16000
     
-    # 1. サイン波（1秒）- 音楽的な音
-    duration = 1.0
-    t = np.linspace(0, duration, int(sample_rate * duration))
-    frequency = 440  # A4音
-    sine_wave = np.sin(2 * np.pi * frequency * t) * 0.5
-    
-    # 2. ホワイトノイズ（0.5秒）- 環境音のシミュレーション
-    noise_duration = 0.5
-    white_noise = np.random.randn(int(sample_rate * noise_duration)) * 0.1
-    
-    # 3. 無音（0.5秒）
-    silence = np.zeros(int(sample_rate * 0.5))
+    # 出力バッファを一度だけ確保（無音で初期化、float32）
+    total_samples = int(sample_rate * 3.2)
+    test_audio = np.zeros(total_samples, dtype=np.float32)
     
-    # 4. クリック音（打撃音のシミュレーション）
-    click = np.zeros(int(sample_rate * 0.2))
-    click[100:120] = 0.8  # 短いパルス
-    
-    # すべてを結合
-    test_audio = np.concatenate([
-        sine_wave,
-        silence,
-        white_noise,
-        silence,
-        click,
-        silence
-    ])
+    # 1. サイン波（0.0-1.0秒）- 音楽的な音
+    sine_samples = int(sample_rate * 1.0)
+    frequency = 440  # A4音
+    sine_wave = test_audio[:sine_samples]
+    np.sin(
+        np.arange(sine_samples, dtype=np.float32) * np.float32(2 * np.pi * frequency / sample_rate),
+        out=sine_wave
+    )
+    sine_wave *= 0.5
+    
+    # 2. ホワイトノイズ（1.5-2.0秒）- 環境音のシミュレーション
+    noise_start = int(sample_rate * 1.5)
+    noise_samples = int(sample_rate * 0.5)
+    rng = np.random.default_rng(0)
+    noise = test_audio[noise_start:noise_start + noise_samples]
+    rng.standard_normal(dtype=np.float32, out=noise)
+    noise *= 0.1
+    
+    # 3. クリック音（2.5-2.7秒）- 打撃音のシミュレーション
+    click_start = int(sample_rate * 2.5)
+    test_audio[click_start + 100:click_start + 120] = 0.8  # 短いパルス
     
     # ファイルに保存
     output_file = "test_audio.wav"
-    sf.write(output_file, test_audio, sample_rate)
+    sf.write(output_file, test_audio, sample_rate, subtype='PCM_16')
     
     total_duration = len(test_audio) / sample_rate
     print(f"✅ テスト音声ファイルを作成しました: {output_file}")
@@ -6,16 +6,18 @@ MIT/ast-finetuned-audioset-10-10-0.4593 モデルを使用
 
 import os
 import io
+import asyncio
 import json
 from typing import List, Dict, Optional
 import traceback
+from contextlib import asynccontextmanager
 
 import torch
+import torchaudio
 import numpy as np
-import librosa
 import soundfile as sf
 from transformers import AutoFeatureExtractor, ASTForAudioClassification
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.responses import JSONResponse
 import uvicorn
 
@@ -23,37 +25,100 @@ import uvicorn
 model = None
 feature_extractor = None
 id2label = None
+LABELS = None  # クラスID順のラベル名リスト（load_modelで作成）
+inference_dtype = torch.float32
 
 # モデル名
 MODEL_NAME = "MIT/ast-finetuned-audioset-10-10-0.4593"
 
+# id2labelに存在しない場合のAudioSet標準ラベルマッピング（一部）
+_FALLBACK_LABELS = {
+    0: "Speech", 47: "Cough", 48: "Throat clearing",
+    62: "Burping, eructation", 137: "Music", 500: "Silence",
+    506: "Inside, small room"
+}
+
+# ビルド時に事前ダウンロードしたモデルの保存先（存在すればHugging Faceに接続せずにロード）
+MODEL_PATH = os.getenv('AST_MODEL_PATH', '/models/ast')
+
+# ワーカープロセス数（WEB_CONCURRENCYで指定）
+# GPU利用時はワーカーごとにモデルがGPUメモリを消費するため1ワーカーで起動し、
+# 並行性はプロセス内の非同期処理とバッチ推論で確保する
+WORKERS = 1 if torch.cuda.is_available() else int(os.getenv('WEB_CONCURRENCY', 4))
+
+# ワーカーごとのPyTorchスレッド数（ワーカー数 × スレッド数がCPUコア数を超えないようにする）
+TORCH_NUM_THREADS = int(os.getenv('TORCH_NUM_THREADS', max(1, (os.cpu_count() or 1) // WORKERS)))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """サーバー起動時にモデルをロード（ワーカープロセスごとに1回）"""
+    # 複数ワーカーでCPUスレッドを奪い合わないよう、ワーカーごとのスレッド数を制限
+    torch.set_num_threads(TORCH_NUM_THREADS)
+    try:
+        torch.set_num_interop_threads(TORCH_NUM_THREADS)
+    except RuntimeError:
+        # 並列処理開始後は変更できないため、その場合は既定値のまま
+        pass
+    load_model()
+    yield
+
 # FastAPIアプリケーション
 app = FastAPI(
     title="AST Audio Event Detection API",
     description="Audio Spectrogram Transformer を使用した音響イベント検出API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 def load_model():
     """モデルとfeature extractorを読み込む"""
-    global model, feature_extractor, id2label
+    global model, feature_extractor, id2label, LABELS, inference_dtype
     
     print(f"モデルをロード中: {MODEL_NAME}")
     try:
         # Feature ExtractorとModelの読み込み
-        feature_extractor = AutoFeatureExtractor.from_pretrained(MODEL_NAME)
-        model = ASTForAudioClassification.from_pretrained(MODEL_NAME)
+        # ローカルのスナップショットがあればそちらを優先
+        local_files_only = os.path.isdir(MODEL_PATH)
+        model_source = MODEL_PATH if local_files_only else MODEL_NAME
+        feature_extractor = AutoFeatureExtractor.from_pretrained(
+            model_source, local_files_only=local_files_only
+        )
+        model = ASTForAudioClassification.from_pretrained(
+            model_source, local_files_only=local_files_only
+        )
         
-        # ラベルマッピングを取得
-        id2label = model.config.id2label
+        # ラベルマッピングを取得（キーを整数に正規化しておく）
+        id2label = {int(k): v for k, v in model.config.id2label.items()}
+        
+        # クラスIDをそのまま添字にできるラベル名リストを作成（予測ごとの辞書引きをなくす）
+        LABELS = [
+            id2label.get(i) or _FALLBACK_LABELS.get(i, f"Event_{i}")
+            for i in range(model.config.num_labels)
+        ]
         
         # CPUで実行（GPUがあればGPUを使用）
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         model.to(device)
         model.eval()
         
+        # GPUまたはAMX対応CPUではbfloat16で推論（重みの帯域を半減）
+        amx_supported = getattr(torch.cpu, "_is_amx_tile_supported", lambda: False)()
+        if device.type == "cuda" or amx_supported:
+            inference_dtype = torch.bfloat16
+            model.to(inference_dtype)
+            
+            # カーネル融合のためにコンパイル
+            compile_model()
+        else:
+            # bfloat16非対応のCPUではLinear層をint8に動的量子化（VNNI命令を活用）
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        
         print(f"✅ モデルのロードに成功しました")
         print(f"   - デバイス: {device}")
+        print(f"   - データ型: {inference_dtype}")
+        print(f"   - int8量子化: {'有効' if device.type == 'cpu' and not amx_supported else '無効'}")
         print(f"   - ラベル数: {len(id2label)}")
         print(f"   - サンプリングレート: {feature_extractor.sampling_rate} Hz")
         
@@ -62,6 +127,24 @@ def load_model():
         traceback.print_exc()
         raise
 
+def compile_model():
+    """
+    torch.compileでモデルをコンパイルし、ダミー入力でウォームアップする
+    （torch.compileは最初の推論まで実際のコンパイルを遅延するため、起動時に済ませておく。
+    失敗した場合はeagerモードのまま使用）
+    """
+    global model
+    
+    eager_model = model
+    try:
+        model = torch.compile(eager_model)
+        dummy_audio = np.zeros(feature_extractor.sampling_rate, dtype=np.float32)
+        predict_audio_events(dummy_audio, top_k=1)
+        print(f"   - torch.compile: 有効")
+    except Exception as e:
+        model = eager_model
+        print(f"⚠️ torch.compileに失敗したためeagerモードで実行します: {str(e)}")
+
 def process_audio(audio_data: np.ndarray, sample_rate: int) -> np.ndarray:
     """
     音声データを前処理する
@@ -74,26 +157,28 @@ def process_audio(audio_data: np.ndarray, sample_rate: int) -> np.ndarray:
         処理済みの音声データ
     """
     # モノラルに変換
-    if len(audio_data.shape) > 1:
-        audio_data = np.mean(audio_data, axis=1)
+    if audio_data.ndim > 1:
+        audio_data = audio_data.mean(axis=1, dtype=np.float32)
+    
+    # モデルと同じデバイス上のテンソルに変換
+    device = next(model.parameters()).device
+    waveform = torch.from_numpy(np.ascontiguousarray(audio_data, dtype=np.float32)).to(device)
     
     # モデルが期待するサンプリングレートにリサンプリング（16kHz）
     target_sr = feature_extractor.sampling_rate
     if sample_rate != target_sr:
-        audio_data = librosa.resample(
-            audio_data, 
-            orig_sr=sample_rate, 
-            target_sr=target_sr
+        waveform = torchaudio.functional.resample(
+            waveform,
+            orig_freq=sample_rate,
+            new_freq=target_sr,
+            lowpass_filter_width=16
         )
     
-    # float32に変換
-    if audio_data.dtype != np.float32:
-        audio_data = audio_data.astype(np.float32)
-    
     # 正規化（-1.0 〜 1.0）
-    max_val = np.max(np.abs(audio_data))
-    if max_val > 0:
-        audio_data = audio_data / max_val
+    waveform.div_(waveform.abs().max().clamp_min(1e-9))
+    
+    # feature extractorはnumpy配列を受け取る
+    audio_data = waveform.cpu().numpy()
     
     return audio_data
 
@@ -115,47 +200,69 @@ def predict_audio_events(audio_data: np.ndarray, top_k: int = 5) -> List[Dict[st
         return_tensors="pt"
     )
     
-    # デバイスに移動
+    # デバイスに移動（モデルと同じデータ型に変換）
     device = next(model.parameters()).device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    inputs = {k: v.to(device, dtype=inference_dtype) for k, v in inputs.items()}
     
     # 推論実行
-    with torch.no_grad():
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type,
+        dtype=inference_dtype,
+        enabled=inference_dtype != torch.float32
+    ):
         outputs = model(**inputs)
-        logits = outputs.logits
+        logits = outputs.logits.float()[0]
     
-    # Softmaxで確率に変換
-    probs = torch.nn.functional.softmax(logits, dim=-1)[0]
+    # Softmaxは単調なのでlogitsのまま上位k個を取得
+    top_logits, top_indices = torch.topk(logits, min(top_k, logits.shape[-1]))
     
-    # 上位k個を取得
-    top_probs, top_indices = torch.topk(probs, min(top_k, len(probs)))
+    # 上位k個だけをSoftmaxの確率に変換（全クラスの確率ベクトルは作らない）
+    top_probs = (top_logits - torch.logsumexp(logits, dim=-1)).exp()
     
     # 結果を整形
-    predictions = []
-    for prob, idx in zip(top_probs.cpu(), top_indices.cpu()):
-        label_id = idx.item()
-        # id2labelのキーは整数と文字列の両方を試す
-        label = id2label.get(label_id) or id2label.get(str(label_id))
-        if not label:
-            # AudioSetの標準ラベルマッピング（一部）
-            audioset_labels = {
-                0: "Speech", 47: "Cough", 48: "Throat clearing",
-                62: "Burping, eructation", 137: "Music", 500: "Silence",
-                506: "Inside, small room"
-            }
-            label = audioset_labels.get(label_id, f"Event_{label_id}")
-        score = prob.item()
-        predictions.append({
-            "label": label,
-            "score": round(score, 4)
-        })
+    predictions = [
+        {"label": LABELS[label_id], "score": round(score, 4)}
+        for score, label_id in zip(top_probs.tolist(), top_indices.tolist())
+    ]
     
     return predictions
 
-@app.on_event("startup")
-async def startup_event():
-    """サーバー起動時にモデルをロード"""
-    load_model()
+def build_analysis_response(audio_file: io.BytesIO, filename: str, top_k: int) -> JSONResponse:
+    """
+    音声データを読み込んで分析し、レスポンスを作成
+    
+    Args:
+        audio_file: 音声データを保持するファイルライクオブジェクト
+        filename: ファイル名
+        top_k: 返す上位予測の数
+    
+    Returns:
+        JSON形式の予測結果
+    """
+    # 音声データをfloat32で読み込む（float64へのデコードを避ける）
+    with sf.SoundFile(audio_file) as sound_file:
+        sample_rate = sound_file.samplerate
+        audio_data = sound_file.read(dtype='float32', always_2d=False)
+    print(f"Audio loaded: {len(audio_data)/sample_rate:.2f} seconds, {sample_rate} Hz")
+    
+    # 音声データの前処理
+    processed_audio = process_audio(audio_data, sample_rate)
+    
+    # 予測実行
+    predictions = predict_audio_events(processed_audio, top_k)
+    
+    # レスポンスを返す
+    response = {
+        "predictions": predictions,
+        "audio_info": {
+            "filename": filename,
+            "duration_seconds": round(len(audio_data) / sample_rate, 2),
+            "sample_rate": sample_rate
+        }
+    }
+    
+    print(f"✅ Analysis complete for {filename}")
+    return JSONResponse(content=response)
 
 @app.get("/")
 async def root():
@@ -163,7 +270,13 @@ async def root():
     return {
         "message": "AST Audio Event Detection API",
         "model": MODEL_NAME,
-        "status": "ready" if model is not None else "not ready"
+        "status": "ready" if model is not None else "not ready",
+        "endpoints": {
+            "/analyze_sound": "音響イベント検出",
+            "/analyze_sound_raw": "音響イベント検出（raw body版）",
+            "/infer": "音響イベント検出（モノラルfloat32の生PCM）",
+            "/health": "ヘルスチェック"
+        }
     }
 
 @app.get("/health")
@@ -207,31 +320,119 @@ async def analyze_sound(
         print(f"Processing file: {file.filename}")
         content = await file.read()
         
-        # 音声データを読み込む
-        audio_data, sample_rate = sf.read(io.BytesIO(content))
-        print(f"Audio loaded: {len(audio_data)/sample_rate:.2f} seconds, {sample_rate} Hz")
+        # 推論はスレッドで実行してイベントループをブロックしない
+        return await asyncio.to_thread(
+            build_analysis_response, io.BytesIO(content), file.filename, top_k
+        )
         
-        # 音声データの前処理
-        processed_audio = process_audio(audio_data, sample_rate)
+    except Exception as e:
+        print(f"❌ Error processing {file.filename}: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error processing audio: {str(e)}")
+
+@app.post("/analyze_sound_raw")
+async def analyze_sound_raw(
+    request: Request,
+    top_k: Optional[int] = 5,
+    filename: Optional[str] = "audio.wav"
+):
+    """
+    リクエストボディの音声データから音響イベントを検出（マルチパート解析なし）
+    
+    Args:
+        request: 音声データをそのままボディに持つリクエスト
+        top_k: 返す上位予測の数（デフォルト: 5）
+        filename: レスポンスに含めるファイル名
+    
+    Returns:
+        JSON形式の予測結果
+    """
+    # モデルがロードされているか確認
+    if model is None or feature_extractor is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    try:
+        # ボディをストリーミングで受信（bytesとして全体を複製しない）
+        print(f"Processing file: {filename}")
+        buffer = io.BytesIO()
+        async for chunk in request.stream():
+            buffer.write(chunk)
+        buffer.seek(0)
         
-        # 予測実行
-        predictions = predict_audio_events(processed_audio, top_k)
+        # 推論はスレッドで実行してイベントループをブロックしない
+        return await asyncio.to_thread(build_analysis_response, buffer, filename, top_k)
         
-        # レスポンスを返す
-        response = {
-            "predictions": predictions,
-            "audio_info": {
-                "filename": file.filename,
-                "duration_seconds": round(len(audio_data) / sample_rate, 2),
-                "sample_rate": sample_rate
-            }
+    except Exception as e:
+        print(f"❌ Error processing {filename}: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error processing audio: {str(e)}")
+
+def build_infer_response(pcm: bytearray, sample_rate: int, top_k: int) -> JSONResponse:
+    """
+    float32のPCMデータを分析し、レスポンスを作成
+    
+    Args:
+        pcm: モノラルfloat32（リトルエンディアン）のPCMデータ
+            （process_audioがインプレースで正規化するため書き込み可能なbytearray）
+        sample_rate: サンプリングレート
+        top_k: 返す上位予測の数
+    
+    Returns:
+        予測結果を含むJSONResponse
+    """
+    audio_data = np.frombuffer(pcm, dtype='<f4')
+    processed_audio = process_audio(audio_data, sample_rate)
+    predictions = predict_audio_events(processed_audio, top_k)
+    
+    return JSONResponse(content={
+        "predictions": predictions,
+        "audio_info": {
+            "duration_seconds": round(len(audio_data) / sample_rate, 2),
+            "sample_rate": sample_rate
         }
-        
-        print(f"✅ Analysis complete for {file.filename}")
-        return JSONResponse(content=response)
+    })
+
+@app.post("/infer")
+async def infer(
+    request: Request,
+    sample_rate: Optional[int] = 16000,
+    top_k: Optional[int] = 5
+):
+    """
+    ボディの生PCM（application/octet-stream、モノラルfloat32）から音響イベントを検出
+    （ロード済みのモデルを使い回すため、テストスクリプトなどからの繰り返し推論に使う）
+    
+    Args:
+        request: numpy.tobytes()したfloat32配列をボディに持つリクエスト
+        sample_rate: サンプリングレート（デフォルト: 16000）
+        top_k: 返す上位予測の数（デフォルト: 5）
+    
+    Returns:
+        JSON形式の予測結果
+    """
+    # モデルがロードされているか確認
+    if model is None or feature_extractor is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    if sample_rate <= 0:
+        raise HTTPException(status_code=400, detail="sample_rate must be positive")
+    if top_k <= 0:
+        raise HTTPException(status_code=400, detail="top_k must be positive")
+    
+    # 書き込み可能なbytearrayに受信する（frombufferの配列をtorchがそのまま書き換えるため、
+    # 読み取り専用のbytesだとリクエストのボディを書き換えてしまう）
+    pcm = bytearray()
+    async for chunk in request.stream():
+        pcm += chunk
+    if len(pcm) == 0 or len(pcm) % 4 != 0:
+        raise HTTPException(status_code=400, detail="Body must be non-empty float32 PCM")
+    
+    try:
+        # 推論はスレッドで実行してイベントループをブロックしない
+        return await asyncio.to_thread(build_infer_response, pcm, sample_rate, top_k)
         
     except Exception as e:
-        print(f"❌ Error processing {file.filename}: {str(e)}")
+        print(f"❌ Error processing PCM: {str(e)}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error processing audio: {str(e)}")
 
@@ -242,9 +443,13 @@ if __name__ == "__main__":
     print(f"Model: {MODEL_NAME}")
     print("=" * 50)
     
+    # 複数ワーカー + uvloop/httptools で起動（ワーカー数はWORKERS）
     uvicorn.run(
-        app,
+        "main:app",
         host="127.0.0.1",
         port=8017,
+        workers=WORKERS,
+        loop="uvloop",
+        http="httptools",
         log_level="info"
     )
\ No newline at end of file
@@ -6,18 +6,18 @@ file_pathsベースの処理でaudio_filesテーブルと連携
 
 import os
 import io
+import asyncio
 import json
-import tempfile
 import traceback
+from contextlib import asynccontextmanager
 from typing import List, Dict, Optional
 from datetime import datetime, timezone
 import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
-import torch
 import numpy as np
-import librosa
 import soundfile as sf
-from transformers import AutoFeatureExtractor, ASTForAudioClassification
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
@@ -26,20 +26,30 @@ import uvicorn
 
 # AWS S3とSupabase
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
-# 環境変数を読み込み
+# 環境変数を読み込み（ast_inferenceが読む環境変数も.envから設定できるよう先に読み込む）
 load_dotenv()
 
-# グローバル変数でモデルを保持
-model = None
-feature_extractor = None
-id2label = None
+# モデルの読み込み・前処理・推論はmain_timeline.pyと共通
+import ast_inference
+from ast_inference import (
+    MODEL_NAME, TARGET_SR, load_model, process_audio, split_segments,
+    predict_timeline_segments, summarize_events
+)
+
+# 同時に処理するファイル数（S3ダウンロードと推論を重ねる）
+FILE_CONCURRENCY = int(os.getenv('FILE_CONCURRENCY', 4))
+
+# S3/Supabaseへの通信用スレッド数（ネットワーク待ちが中心なので多め）
+IO_POOL_SIZE = int(os.getenv('IO_POOL_SIZE', 16))
 
-# モデル名
-MODEL_NAME = "MIT/ast-finetuned-audioset-10-10-0.4593"
+# 音声デコード・前処理用スレッド数（CPU処理なのでコア数まで、推論は推論専用スレッドで実行）
+CPU_POOL_SIZE = int(os.getenv('CPU_POOL_SIZE', os.cpu_count() or 1))
 
 # Supabaseクライアントの初期化
 supabase_url = os.getenv('SUPABASE_URL')
@@ -60,19 +70,44 @@ aws_region = os.getenv('AWS_REGION', 'us-east-1')
 if not aws_access_key_id or not aws_secret_access_key:
     raise ValueError("AWS_ACCESS_KEY_IDおよびAWS_SECRET_ACCESS_KEYが設定されていません")
 
+# 並行ダウンロードで接続プールを共有できるようにする
 s3_client = boto3.client(
     's3',
     aws_access_key_id=aws_access_key_id,
     aws_secret_access_key=aws_secret_access_key,
-    region_name=aws_region
+    region_name=aws_region,
+    config=Config(
+        tcp_keepalive=True,
+        max_pool_connections=max(32, FILE_CONCURRENCY * 4),
+        retries={'max_attempts': 5, 'mode': 'adaptive'}
+    )
+)
+
+# 大きな音声ファイルは16MB単位の並列レンジ取得でダウンロード
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=8,
+    io_chunksize=1024 * 1024
 )
 print(f"✅ AWS S3接続設定完了: バケット={s3_bucket_name}, リージョン={aws_region}")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """サーバー起動時にモデルをロードし、リクエスト間で共有するスレッドプールを作成"""
+    load_model()
+    app.state.io_pool = ThreadPoolExecutor(max_workers=IO_POOL_SIZE, thread_name_prefix="io")
+    app.state.cpu_pool = ThreadPoolExecutor(max_workers=CPU_POOL_SIZE, thread_name_prefix="cpu")
+    yield
+    app.state.io_pool.shutdown(wait=False)
+    app.state.cpu_pool.shutdown(wait=False)
+
 # FastAPIアプリケーション
 app = FastAPI(
     title="AST Audio Event Detection API with Supabase",
     description="Audio Spectrogram Transformer を使用した音響イベント検出API（Supabase統合版）",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # CORSミドルウェアの設定
@@ -93,30 +128,20 @@ class FetchAndProcessPathsRequest(BaseModel):
     segment_duration: Optional[float] = 10.0  # セグメントの長さ（秒）- 10秒が最適
     overlap: Optional[float] = 0.0  # オーバーラップ率 - オーバーラップなしが最適
 
-def load_model():
-    """モデルとfeature extractorを読み込む"""
-    global model, feature_extractor, id2label
+async def run_in_pool(pool: ThreadPoolExecutor, func, *args, **kwargs):
+    """
+    ブロッキング処理を共有スレッドプールで実行する
     
-    print(f"🔄 モデルをロード中: {MODEL_NAME}")
-    try:
-        feature_extractor = AutoFeatureExtractor.from_pretrained(MODEL_NAME)
-        model = ASTForAudioClassification.from_pretrained(MODEL_NAME)
-        
-        # ラベルマッピングを取得
-        id2label = model.config.id2label
-        
-        # CPUで実行
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model.to(device)
-        model.eval()
-        
-        print(f"✅ モデルのロードに成功しました")
-        print(f"   - デバイス: {device}")
-        print(f"   - ラベル数: {len(id2label)}")
-        
-    except Exception as e:
-        print(f"❌ モデルのロードに失敗しました: {str(e)}")
-        raise
+    Args:
+        pool: 実行するスレッドプール（app.state.io_pool または app.state.cpu_pool）
+        func: 実行する関数
+        *args, **kwargs: 関数の引数
+    
+    Returns:
+        関数の戻り値
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
 
 def extract_info_from_file_path(file_path: str) -> Dict[str, str]:
     """
@@ -147,186 +172,119 @@ def extract_info_from_file_path(file_path: str) -> Dict[str, str]:
             'time_block': 'unknown'
         }
 
-async def update_audio_files_status(file_path: str, status: str = 'completed'):
+async def update_audio_files_status(file_paths: List[str], status: str = 'completed'):
     """
-    audio_filesテーブルのbehavior_features_statusを更新（YamNetと同じフィールドを使用）
+    audio_filesテーブルのbehavior_features_statusをまとめて更新（YamNetと同じフィールドを使用）
     
     Args:
-        file_path: ファイルパス
+        file_paths: ファイルパスのリスト（1回のリクエストで更新）
         status: ステータス ('pending', 'processing', 'completed', 'error')
     """
+    if not file_paths:
+        return True
+    
     try:
-        update_response = supabase.table('audio_files') \
+        update_query = supabase.table('audio_files') \
             .update({'behavior_features_status': status}) \
-            .eq('file_path', file_path) \
-            .execute()
+            .in_('file_path', file_paths)
+        update_response = await run_in_pool(app.state.io_pool, update_query.execute)
         
         if update_response.data:
-            print(f"✅ ステータス更新成功: {file_path} -> {status}")
+            print(f"✅ ステータス更新成功: {len(update_response.data)}件 -> {status}")
             return True
         else:
-            print(f"⚠️ 対象レコードが見つかりません: {file_path}")
+            print(f"⚠️ 対象レコードが見つかりません: {len(file_paths)}件")
             return False
             
     except Exception as e:
         print(f"❌ ステータス更新エラー: {str(e)}")
         return False
 
-async def save_to_behavior_yamnet(device_id: str, date: str, time_block: str, 
-                                  timeline_data: List[Dict]):
+async def save_to_behavior_yamnet(results: List[Dict]) -> set:
     """
-    behavior_yamnetテーブルにタイムライン形式の結果を保存
+    behavior_yamnetテーブルにタイムライン形式の結果をまとめて保存
     
     Args:
-        device_id: デバイスID
-        date: 日付
-        time_block: 時間ブロック
-        timeline_data: タイムライン形式のイベントデータ
+        results: process_single_fileの成功結果のリスト
+    
+    Returns:
+        保存できた (device_id, date, time_block) の集合
     """
+    if not results:
+        return set()
+    
     try:
         # 現在のUTCタイムスタンプを取得
         created_at = datetime.now(timezone.utc).isoformat()
         
         # タイムライン形式のデータをeventsカラムに保存
-        data = {
-            'device_id': device_id,
-            'date': date,
-            'time_block': time_block,
-            'events': timeline_data,  # タイムライン形式のデータ
-            'status': 'completed',  # ASTによる処理完了
-            'created_at': created_at  # タイムスタンプを追加
-        }
+        # （同じキーの行が1回のupsertに複数あるとエラーになるため、後のものを優先）
+        rows = {}
+        for result in results:
+            key = (result['device_id'], result['date'], result['time_block'])
+            rows[key] = {
+                'device_id': result['device_id'],
+                'date': result['date'],
+                'time_block': result['time_block'],
+                'events': result['timeline']['timeline'],  # タイムライン形式のデータ
+                'status': 'completed',  # ASTによる処理完了
+                'created_at': created_at  # タイムスタンプを追加
+            }
         
-        # upsert（既存データがあれば更新、なければ挿入）
-        response = supabase.table('behavior_yamnet') \
-            .upsert(data, on_conflict='device_id,date,time_block') \
-            .execute()
+        # upsert（既存データがあれば更新、なければ挿入）を1回のリクエストで実行
+        upsert_query = supabase.table('behavior_yamnet') \
+            .upsert(list(rows.values()), on_conflict='device_id,date,time_block')
+        response = await run_in_pool(app.state.io_pool, upsert_query.execute)
         
-        if response.data:
-            print(f"✅ データ保存成功: {device_id}/{date}/{time_block}")
-            return True
+        # 返ってきた行から保存できたキーを判定
+        saved_keys = {
+            (row.get('device_id'), row.get('date'), row.get('time_block'))
+            for row in (response.data or [])
+        }
+        if saved_keys:
+            print(f"✅ データ保存成功: {len(saved_keys)}/{len(rows)}件")
         else:
             print(f"⚠️ データ保存失敗: レスポンスが空です")
-            return False
+        return saved_keys
             
     except Exception as e:
         print(f"❌ データ保存エラー: {str(e)}")
         traceback.print_exc()
-        return False
+        return set()
 
-def download_from_s3(file_path: str, local_path: str) -> bool:
+def download_from_s3(file_path: str) -> Optional[io.BytesIO]:
     """
-    S3から音声ファイルをダウンロード
+    S3から音声ファイルをメモリに直接ダウンロード（一時ファイルを使わない）
     
     Args:
         file_path: S3のファイルパス
-        local_path: ローカル保存先パス
     
     Returns:
-        成功時True、失敗時False
+        成功時はファイルの内容（先頭にシーク済みのBytesIO）、失敗時None
     """
     try:
         print(f"📥 S3からダウンロード中: {file_path}")
-        s3_client.download_file(s3_bucket_name, file_path, local_path)
+        buffer = io.BytesIO()
+        s3_client.download_fileobj(
+            s3_bucket_name, file_path, buffer, Config=S3_TRANSFER_CONFIG
+        )
+        buffer.seek(0)
         print(f"✅ ダウンロード完了: {file_path}")
-        return True
+        return buffer
     except ClientError as e:
         error_code = e.response['Error']['Code']
-        if error_code == '404':
+        if error_code in ('404', 'NoSuchKey'):
             print(f"❌ ファイルが見つかりません: {file_path}")
         else:
             print(f"❌ S3ダウンロードエラー: {error_code} - {str(e)}")
-        return False
+        return None
     except Exception as e:
         print(f"❌ 予期しないエラー: {str(e)}")
-        return False
-
-def process_audio(audio_data: np.ndarray, sample_rate: int) -> np.ndarray:
-    """
-    音声データを前処理する
-    
-    Args:
-        audio_data: 音声データ（numpy配列）
-        sample_rate: サンプリングレート
-    
-    Returns:
-        処理済みの音声データ
-    """
-    # モノラルに変換
-    if len(audio_data.shape) > 1:
-        audio_data = np.mean(audio_data, axis=1)
-    
-    # モデルが期待するサンプリングレートにリサンプリング（16kHz）
-    target_sr = feature_extractor.sampling_rate
-    if sample_rate != target_sr:
-        audio_data = librosa.resample(
-            audio_data, 
-            orig_sr=sample_rate, 
-            target_sr=target_sr
-        )
-    
-    # float32に変換
-    if audio_data.dtype != np.float32:
-        audio_data = audio_data.astype(np.float32)
-    
-    # 正規化（-1.0 〜 1.0）
-    max_val = np.max(np.abs(audio_data))
-    if max_val > 0:
-        audio_data = audio_data / max_val
-    
-    return audio_data
-
-def predict_audio_events(audio_data: np.ndarray, top_k: int = 5, threshold: float = 0.1) -> List[Dict]:
-    """
-    音声データから音響イベントを予測
-    
-    Args:
-        audio_data: 前処理済みの音声データ
-        top_k: 返す上位予測の数
-        threshold: 最小確率しきい値
-    
-    Returns:
-        予測結果のリスト
-    """
-    # 特徴抽出
-    inputs = feature_extractor(
-        audio_data,
-        sampling_rate=feature_extractor.sampling_rate,
-        return_tensors="pt"
-    )
-    
-    # デバイスに移動
-    device = next(model.parameters()).device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-    
-    # 推論実行
-    with torch.no_grad():
-        outputs = model(**inputs)
-        logits = outputs.logits
-    
-    # Softmaxで確率に変換
-    probs = torch.nn.functional.softmax(logits, dim=-1)[0]
-    
-    # 上位k個を取得
-    top_probs, top_indices = torch.topk(probs, min(top_k, len(probs)))
-    
-    # 結果を整形
-    predictions = []
-    for prob, idx in zip(top_probs.cpu(), top_indices.cpu()):
-        score = prob.item()
-        if score >= threshold:  # しきい値以上のみ
-            label_id = idx.item()
-            label = id2label.get(label_id) or id2label.get(str(label_id)) or f"Event_{label_id}"
-            predictions.append({
-                "label": label,
-                "score": round(score, 4)
-            })
-    
-    return predictions
+        return None
 
 def analyze_timeline(audio_data: np.ndarray, sample_rate: int, 
-                    segment_duration: float = 1.0, 
-                    overlap: float = 0.5,
+                    segment_duration: float = 10.0, 
+                    overlap: float = 0.0,
                     top_k: int = 3,
                     threshold: float = 0.1) -> Dict:
     """
@@ -345,68 +303,39 @@ def analyze_timeline(audio_data: np.ndarray, sample_rate: int,
     """
     # 音声を前処理
     processed_audio = process_audio(audio_data, sample_rate)
-    target_sr = feature_extractor.sampling_rate
     
     # セグメント設定
-    segment_samples = int(segment_duration * target_sr)
+    segment_samples = int(segment_duration * TARGET_SR)
     hop_samples = int(segment_samples * (1 - overlap))
     
     # タイムライン結果を格納
     timeline = []
-    all_events = {}
     
     # 音声が短い場合（segment_duration未満）は全体を1セグメントとして処理
-    if len(processed_audio) < segment_samples:
-        # 短い音声は全体を1つのセグメントとして処理
-        events = predict_audio_events(processed_audio, top_k, threshold)
+    segments, start_indices = split_segments(
+        processed_audio, segment_samples, hop_samples, keep_short_audio=True
+    )
+    
+    # 無音以外のセグメントだけをバッチ単位でまとめて推論
+    segment_events = predict_timeline_segments(segments, top_k, threshold)
+    
+    for start_idx, events in zip(start_indices, segment_events):
+        time_position = start_idx / TARGET_SR
+        
+        # タイムラインに追加
         timeline.append({
-            "time": 0.0,
+            "time": round(time_position, 1),
             "events": events
         })
-        # イベントの集計
-        for event in events:
-            label = event["label"]
-            if label not in all_events:
-                all_events[label] = {"count": 0, "total_score": 0}
-            all_events[label]["count"] += 1
-            all_events[label]["total_score"] += event["score"]
-    else:
-        # 通常のセグメント処理
-        for i in range(0, len(processed_audio) - segment_samples + 1, hop_samples):
-            segment = processed_audio[i:i + segment_samples]
-            time_position = i / target_sr
-            
-            # セグメントの予測
-            events = predict_audio_events(segment, top_k, threshold)
-            
-            # タイムラインに追加
-            timeline.append({
-                "time": round(time_position, 1),
-                "events": events
-            })
-            
-            # イベントの集計
-            for event in events:
-                label = event["label"]
-                if label not in all_events:
-                    all_events[label] = {"count": 0, "total_score": 0}
-                all_events[label]["count"] += 1
-                all_events[label]["total_score"] += event["score"]
     
     # 最も頻繁なイベントを集計
-    most_common = []
-    for label, stats in sorted(all_events.items(), key=lambda x: x[1]["count"], reverse=True)[:5]:
-        most_common.append({
-            "label": label,
-            "occurrences": stats["count"],
-            "average_score": round(stats["total_score"] / stats["count"], 4)
-        })
+    most_common = summarize_events(segment_events)
     
     return {
         "timeline": timeline,
         "summary": {
             "total_segments": len(timeline),
-            "duration_seconds": round(len(processed_audio) / target_sr, 1),
+            "duration_seconds": round(len(processed_audio) / TARGET_SR, 1),
             "segment_duration": segment_duration,
             "overlap": overlap,
             "most_common_events": most_common
@@ -415,8 +344,8 @@ def analyze_timeline(audio_data: np.ndarray, sample_rate: int,
 
 async def process_single_file(file_path: str, threshold: float = 0.1, top_k: int = 5,
                              analyze_timeline_flag: bool = True, 
-                             segment_duration: float = 1.0,
-                             overlap: float = 0.5) -> Dict:
+                             segment_duration: float = 10.0,
+                             overlap: float = 0.0) -> Dict:
     """
     単一ファイルを処理（タイムライン形式で保存）
     
@@ -431,71 +360,42 @@ async def process_single_file(file_path: str, threshold: float = 0.1, top_k: int
     Returns:
         処理結果
     """
-    temp_file = None
     try:
         # ファイル情報を抽出
         file_info = extract_info_from_file_path(file_path)
         
-        # ステータスを処理中に更新
-        await update_audio_files_status(file_path, 'processing')
-        
-        # 一時ファイルを作成してダウンロード
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp:
-            temp_file = tmp.name
-        
-        if not download_from_s3(file_path, temp_file):
-            await update_audio_files_status(file_path, 'error')
+        # ブロッキング処理はスレッドで実行し、他ファイルの処理と並行させる
+        content = await run_in_pool(app.state.io_pool, download_from_s3, file_path)
+        if content is None:
             return {"status": "error", "file_path": file_path, "error": "Download failed"}
         
-        # 音声データを読み込む
-        audio_data, sample_rate = sf.read(temp_file)
+        # 音声データをメモリから読み込む
+        audio_data, sample_rate = await run_in_pool(app.state.cpu_pool, sf.read, content, dtype='float32')
         print(f"🎵 音声ロード完了: {len(audio_data)/sample_rate:.2f}秒, {sample_rate}Hz")
         
-        # タイムライン分析を実行（必須）
-        timeline_result = analyze_timeline(
+        # タイムライン分析を実行（必須）- 推論中も他ファイルのダウンロードは進む
+        # （モデルの推論はast_inferenceの推論専用スレッドで1つずつ実行される）
+        timeline_result = await run_in_pool(
+            app.state.cpu_pool,
+            analyze_timeline,
             audio_data, sample_rate,
             segment_duration, overlap, top_k, threshold
         )
         
-        # タイムライン形式のデータをbehavior_yamnetテーブルに保存
-        save_success = await save_to_behavior_yamnet(
-            file_info['device_id'],
-            file_info['date'],
-            file_info['time_block'],
-            timeline_result['timeline']  # タイムラインデータのみを保存
-        )
-        
-        if save_success:
-            # ステータスを完了に更新
-            await update_audio_files_status(file_path, 'completed')
-            
-            return {
-                "status": "success",
-                "file_path": file_path,
-                "device_id": file_info['device_id'],
-                "date": file_info['date'],
-                "time_block": file_info['time_block'],
-                "timeline": timeline_result
-            }
-        else:
-            await update_audio_files_status(file_path, 'error')
-            return {"status": "error", "file_path": file_path, "error": "Save failed"}
+        # behavior_yamnetへの保存とステータス更新は呼び出し側で全ファイルまとめて行う
+        return {
+            "status": "success",
+            "file_path": file_path,
+            "device_id": file_info['device_id'],
+            "date": file_info['date'],
+            "time_block": file_info['time_block'],
+            "timeline": timeline_result
+        }
             
     except Exception as e:
         print(f"❌ ファイル処理エラー: {file_path} - {str(e)}")
         traceback.print_exc()
-        await update_audio_files_status(file_path, 'error')
         return {"status": "error", "file_path": file_path, "error": str(e)}
-        
-    finally:
-        # 一時ファイルを削除
-        if temp_file and os.path.exists(temp_file):
-            os.remove(temp_file)
-
-@app.on_event("startup")
-async def startup_event():
-    """サーバー起動時にモデルをロード"""
-    load_model()
 
 @app.get("/")
 async def root():
@@ -504,7 +404,7 @@ async def root():
         "message": "AST Audio Event Detection API with Supabase Integration",
         "model": MODEL_NAME,
         "version": "2.0.0",
-        "status": "ready" if model is not None else "not ready",
+        "status": "ready" if ast_inference.model is not None else "not ready",
         "endpoints": {
             "/fetch-and-process-paths": "Process audio files from S3 via file paths",
             "/health": "Health check endpoint"
@@ -515,8 +415,8 @@ async def root():
 async def health_check():
     """ヘルスチェックエンドポイント"""
     return {
-        "status": "healthy" if model is not None else "unhealthy",
-        "model_loaded": model is not None,
+        "status": "healthy" if ast_inference.model is not None else "unhealthy",
+        "model_loaded": ast_inference.model is not None,
         "supabase_connected": supabase is not None,
         "s3_connected": s3_client is not None
     }
@@ -533,7 +433,7 @@ async def fetch_and_process_paths(request: FetchAndProcessPathsRequest):
         処理結果のサマリーと詳細
     """
     # モデルがロードされているか確認
-    if model is None or feature_extractor is None:
+    if ast_inference.model is None or ast_inference.feature_extractor is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     start_time = time.time()
@@ -545,25 +445,51 @@ async def fetch_and_process_paths(request: FetchAndProcessPathsRequest):
     
     print(f"🚀 処理開始: {len(request.file_paths)}個のファイル")
     
-    # 各ファイルを処理
-    for file_path in request.file_paths:
-        result = await process_single_file(
-            file_path,
-            request.threshold,
-            request.top_k,
-            request.analyze_timeline,
-            request.segment_duration,
-            request.overlap
-        )
-        
+    # ステータスを処理中に更新（全ファイルまとめて）
+    await update_audio_files_status(request.file_paths, 'processing')
+    
+    # 各ファイルを並行して処理（同時実行数はFILE_CONCURRENCYで制限）
+    semaphore = asyncio.Semaphore(FILE_CONCURRENCY)
+    
+    async def process_with_limit(file_path: str) -> Dict:
+        async with semaphore:
+            return await process_single_file(
+                file_path,
+                request.threshold,
+                request.top_k,
+                request.analyze_timeline,
+                request.segment_duration,
+                request.overlap
+            )
+    
+    results = await asyncio.gather(
+        *(process_with_limit(file_path) for file_path in request.file_paths)
+    )
+    
+    # 成功したファイルの結果をbehavior_yamnetテーブルに1回のupsertで保存
+    saved_keys = await save_to_behavior_yamnet(
+        [result for result in results if result["status"] == "success"]
+    )
+    
+    for file_path, result in zip(request.file_paths, results):
         if result["status"] == "success":
-            processed_files.append(file_path)
-            processed_time_blocks.add(result["time_block"])
-        else:
-            error_files.append({
-                "file_path": file_path,
-                "error": result.get("error", "Unknown error")
-            })
+            key = (result["device_id"], result["date"], result["time_block"])
+            if key in saved_keys:
+                processed_files.append(file_path)
+                processed_time_blocks.add(result["time_block"])
+                continue
+            result = {"status": "error", "file_path": file_path, "error": "Save failed"}
+        
+        error_files.append({
+            "file_path": file_path,
+            "error": result.get("error", "Unknown error")
+        })
+    
+    # ステータスを完了/エラーにまとめて更新
+    await asyncio.gather(
+        update_audio_files_status(processed_files, 'completed'),
+        update_audio_files_status([error["file_path"] for error in error_files], 'error')
+    )
     
     # 実行時間を計算
     execution_time = time.time() - start_time
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 AST (Audio Spectrogram Transformer) 音響イベント検出API - 時系列版
-1秒ごとに音声を分析して時系列データを生成
+10秒ごと（ASTの入力長）に音声を分析して時系列データを生成
 """
 
 import os
@@ -9,32 +9,49 @@ import io
 import json
 from typing import List, Dict, Optional
 import traceback
+from contextlib import asynccontextmanager
 
-import torch
 import numpy as np
-import librosa
 import soundfile as sf
-from transformers import AutoFeatureExtractor, ASTForAudioClassification
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
 import uvicorn
 
-# グローバル変数でモデルを保持
-model = None
-feature_extractor = None
-id2label = None
+# モデルの読み込み・前処理・推論はmain_supabase.pyと共通
+import ast_inference
+from ast_inference import (
+    MODEL_NAME, TARGET_SR, load_model, process_audio, split_segments,
+    predict_segments, predict_timeline_segments, summarize_events
+)
+
+# セグメント分割のデフォルト値
+# ASTの入力は最大1024フレーム（10ms間隔で約10.24秒）なので、10秒セグメントが最も効率的
+# （短いセグメントはパディング部分の計算が無駄になり、推論回数も増える）
+DEFAULT_SEGMENT_DURATION = 10.0
+DEFAULT_OVERLAP = 0.0
 
-# モデル名
-MODEL_NAME = "MIT/ast-finetuned-audioset-10-10-0.4593"
+# これより短いセグメントは非推奨（ログに警告を出す）
+MIN_RECOMMENDED_SEGMENT_DURATION = 5.0
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """サーバー起動時にモデルをロード（ワーカープロセスごとに1回）"""
+    load_model()
+    yield
 
 # FastAPIアプリケーション
 app = FastAPI(
     title="AST Audio Timeline Detection API",
     description="Audio Spectrogram Transformer を使用した時系列音響イベント検出API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# 大きなタイムラインのレスポンスをgzip圧縮して返す
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # レスポンスモデル
 class TimelineEvent(BaseModel):
     time: float
@@ -45,105 +62,9 @@ class TimelineResponse(BaseModel):
     audio_info: Dict
     summary: Dict
 
-def load_model():
-    """モデルとfeature extractorを読み込む"""
-    global model, feature_extractor, id2label
-    
-    print(f"モデルをロード中: {MODEL_NAME}")
-    try:
-        feature_extractor = AutoFeatureExtractor.from_pretrained(MODEL_NAME)
-        model = ASTForAudioClassification.from_pretrained(MODEL_NAME)
-        
-        # ラベルマッピングを取得
-        id2label = model.config.id2label
-        
-        # CPUで実行
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model.to(device)
-        model.eval()
-        
-        print(f"✅ モデルのロードに成功しました")
-        print(f"   - デバイス: {device}")
-        print(f"   - ラベル数: {len(id2label)}")
-        
-    except Exception as e:
-        print(f"❌ モデルのロードに失敗しました: {str(e)}")
-        raise
-
-def predict_segment(audio_segment: np.ndarray, top_k: int = 3) -> List[Dict[str, float]]:
-    """
-    音声セグメントから音響イベントを予測
-    
-    Args:
-        audio_segment: 音声セグメント（1秒分）
-        top_k: 返す上位予測の数
-    
-    Returns:
-        予測結果のリスト
-    """
-    # 特徴抽出
-    inputs = feature_extractor(
-        audio_segment,
-        sampling_rate=16000,
-        return_tensors="pt",
-        padding=True
-    )
-    
-    # デバイスに移動
-    device = next(model.parameters()).device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-    
-    # 推論実行
-    with torch.no_grad():
-        outputs = model(**inputs)
-        logits = outputs.logits
-    
-    # Softmaxで確率に変換
-    probs = torch.nn.functional.softmax(logits, dim=-1)[0]
-    
-    # 上位k個を取得
-    top_probs, top_indices = torch.topk(probs, min(top_k, len(probs)))
-    
-    # 結果を整形
-    predictions = []
-    for prob, idx in zip(top_probs.cpu(), top_indices.cpu()):
-        label_id = idx.item()
-        # AudioSetの主要ラベルマッピング
-        audioset_labels = {
-            0: "Speech", 1: "Male speech", 2: "Female speech",
-            3: "Child speech", 7: "Speech synthesizer",
-            16: "Laughter", 17: "Baby laughter", 20: "Belly laugh",
-            47: "Cough", 48: "Throat clearing", 49: "Sneeze",
-            50: "Sniff", 62: "Burping", 63: "Hiccup",
-            70: "Conversation", 137: "Music", 
-            500: "Silence", 506: "Inside, small room",
-            507: "Inside, large room", 508: "Inside, public space",
-            509: "Outside, urban", 510: "Outside, rural",
-            511: "Reverberation", 512: "Echo",
-            513: "Noise", 514: "Environmental noise", 515: "Static",
-            516: "Mains hum", 517: "Distortion", 518: "Sidetone",
-            519: "Cacophony", 520: "White noise", 521: "Pink noise",
-            522: "Throbbing", 523: "Vibration", 524: "Hum",
-            525: "Whoosh", 526: "Fire"
-        }
-        
-        # まずid2labelから取得を試みる
-        label = id2label.get(label_id) or id2label.get(str(label_id))
-        # 見つからなければaudioset_labelsから
-        if not label:
-            label = audioset_labels.get(label_id, f"Event_{label_id}")
-        
-        score = prob.item()
-        predictions.append({
-            "label": label,
-            "score": round(score, 4)
-        })
-    
-    return predictions
-
 def analyze_timeline(audio_data: np.ndarray, sample_rate: int, 
-                    segment_duration: float = 1.0, 
-                    overlap: float = 0.5,
+                    segment_duration: float = DEFAULT_SEGMENT_DURATION, 
+                    overlap: float = DEFAULT_OVERLAP,
                     top_k: int = 3) -> Dict:
     """
     音声データを時系列で分析
@@ -152,25 +73,20 @@ def analyze_timeline(audio_data: np.ndarray, sample_rate: int,
         audio_data: 音声データ全体
         sample_rate: サンプリングレート
         segment_duration: セグメントの長さ（秒）
-        overlap: オーバーラップ（0.5 = 50%）
+        overlap: オーバーラップ（0-1、0.0 = オーバーラップなし）
         top_k: 各時刻で返すイベント数
     
     Returns:
         時系列分析結果
     """
-    # モノラルに変換
-    if len(audio_data.shape) > 1:
-        audio_data = np.mean(audio_data, axis=1)
-    
-    # 16kHzにリサンプリング
-    if sample_rate != 16000:
-        audio_data = librosa.resample(audio_data, orig_sr=sample_rate, target_sr=16000)
-        sample_rate = 16000
+    if segment_duration < MIN_RECOMMENDED_SEGMENT_DURATION:
+        print(f"⚠️ segment_duration={segment_duration}秒は短すぎます。"
+              f"推論回数が増え、ASTの入力長（約10秒）の大半がパディングになります"
+              f"（推奨: {DEFAULT_SEGMENT_DURATION}秒）")
     
-    # 正規化
-    max_val = np.max(np.abs(audio_data))
-    if max_val > 0:
-        audio_data = audio_data / max_val
+    # モノラル化・16kHzへのリサンプリング・正規化
+    audio_data = process_audio(audio_data, sample_rate)
+    sample_rate = TARGET_SR
     
     # セグメント分割のパラメータ
     segment_samples = int(segment_duration * sample_rate)
@@ -179,34 +95,19 @@ def analyze_timeline(audio_data: np.ndarray, sample_rate: int,
     # タイムライン結果を格納
     timeline = []
     
-    # 全体の統計情報
-    all_events = {}
+    # スライディングウィンドウでセグメントを切り出し、無音以外をバッチ単位で推論
+    segments, start_indices = split_segments(audio_data, segment_samples, hop_samples)
+    segment_events = predict_timeline_segments(segments, top_k=top_k)
     
-    # スライディングウィンドウで分析
-    for start_idx in range(0, len(audio_data) - segment_samples + 1, hop_samples):
-        # セグメントを抽出
-        end_idx = start_idx + segment_samples
-        segment = audio_data[start_idx:end_idx]
-        
+    for start_idx, events in zip(start_indices, segment_events):
         # 時刻を計算（秒）
         time_sec = start_idx / sample_rate
         
-        # セグメントを分析
-        events = predict_segment(segment, top_k=top_k)
-        
         # タイムラインに追加
         timeline.append({
             "time": round(time_sec, 1),
             "events": events
         })
-        
-        # 統計情報を更新
-        for event in events:
-            label = event["label"]
-            if label not in all_events:
-                all_events[label] = {"count": 0, "total_score": 0}
-            all_events[label]["count"] += 1
-            all_events[label]["total_score"] += event["score"]
     
     # サマリーを計算
     summary = {
@@ -214,32 +115,48 @@ def analyze_timeline(audio_data: np.ndarray, sample_rate: int,
         "duration_seconds": len(audio_data) / sample_rate,
         "segment_duration": segment_duration,
         "overlap": overlap,
-        "most_common_events": []
+        # イベントを出現回数順に集計して上位5つを取得
+        "most_common_events": summarize_events(segment_events)
     }
     
-    # イベントをソートして上位5つを取得
-    sorted_events = sorted(
-        [(k, v["count"], v["total_score"]/v["count"]) for k, v in all_events.items()],
-        key=lambda x: x[1],
-        reverse=True
-    )[:5]
-    
-    for label, count, avg_score in sorted_events:
-        summary["most_common_events"].append({
-            "label": label,
-            "occurrences": count,
-            "average_score": round(avg_score, 4)
-        })
-    
     return {
         "timeline": timeline,
         "summary": summary
     }
 
-@app.on_event("startup")
-async def startup_event():
-    """サーバー起動時にモデルをロード"""
-    load_model()
+def build_timeline_response(audio_data: np.ndarray, sample_rate: int, filename: str,
+                            segment_duration: float, overlap: float, top_k: int) -> JSONResponse:
+    """
+    時系列分析を実行してレスポンスを作成
+    
+    Args:
+        audio_data: 音声データ全体
+        sample_rate: サンプリングレート
+        filename: ファイル名
+        segment_duration: セグメントの長さ（秒）
+        overlap: オーバーラップ（0-1）
+        top_k: 各時刻で返すイベント数
+    
+    Returns:
+        時系列分析結果のJSONレスポンス
+    """
+    # 時系列分析を実行
+    result = analyze_timeline(
+        audio_data, sample_rate,
+        segment_duration=segment_duration,
+        overlap=overlap,
+        top_k=top_k
+    )
+    
+    # 音声情報を追加
+    result["audio_info"] = {
+        "filename": filename,
+        "duration_seconds": round(len(audio_data) / sample_rate, 2),
+        "sample_rate": sample_rate
+    }
+    
+    print(f"✅ Timeline analysis complete: {len(result['timeline'])} segments")
+    return JSONResponse(content=result)
 
 @app.get("/")
 async def root():
@@ -249,6 +166,7 @@ async def root():
         "model": MODEL_NAME,
         "endpoints": {
             "/analyze_timeline": "時系列音響イベント検出",
+            "/analyze_timeline_raw": "時系列音響イベント検出（raw body版）",
             "/analyze_sound": "全体音響イベント検出"
         }
     }
@@ -256,8 +174,8 @@ async def root():
 @app.post("/analyze_timeline")
 async def analyze_timeline_endpoint(
     file: UploadFile = File(...),
-    segment_duration: Optional[float] = 1.0,
-    overlap: Optional[float] = 0.5,
+    segment_duration: Optional[float] = DEFAULT_SEGMENT_DURATION,
+    overlap: Optional[float] = DEFAULT_OVERLAP,
     top_k: Optional[int] = 3
 ):
     """
@@ -265,14 +183,14 @@ async def analyze_timeline_endpoint(
     
     Args:
         file: 音声ファイル
-        segment_duration: セグメントの長さ（秒）デフォルト: 1.0
-        overlap: オーバーラップ（0-1）デフォルト: 0.5
+        segment_duration: セグメントの長さ（秒）デフォルト: 10.0
+        overlap: オーバーラップ（0-1）デフォルト: 0.0
         top_k: 各時刻で返すイベント数 デフォルト: 3
     
     Returns:
         時系列分析結果
     """
-    if model is None or feature_extractor is None:
+    if ast_inference.model is None or ast_inference.feature_extractor is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
@@ -281,26 +199,59 @@ async def analyze_timeline_endpoint(
         content = await file.read()
         
         # 音声データを読み込む
-        audio_data, sample_rate = sf.read(io.BytesIO(content))
+        audio_data, sample_rate = sf.read(io.BytesIO(content), dtype='float32')
         print(f"Audio loaded: {len(audio_data)/sample_rate:.2f} seconds, {sample_rate} Hz")
         
-        # 時系列分析を実行
-        result = analyze_timeline(
-            audio_data, sample_rate,
-            segment_duration=segment_duration,
-            overlap=overlap,
-            top_k=top_k
+        return build_timeline_response(
+            audio_data, sample_rate, file.filename,
+            segment_duration, overlap, top_k
         )
         
-        # 音声情報を追加
-        result["audio_info"] = {
-            "filename": file.filename,
-            "duration_seconds": round(len(audio_data) / sample_rate, 2),
-            "sample_rate": sample_rate
-        }
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+@app.post("/analyze_timeline_raw")
+async def analyze_timeline_raw_endpoint(
+    request: Request,
+    segment_duration: Optional[float] = DEFAULT_SEGMENT_DURATION,
+    overlap: Optional[float] = DEFAULT_OVERLAP,
+    top_k: Optional[int] = 3,
+    filename: Optional[str] = "audio.wav"
+):
+    """
+    リクエストボディの音声データから時系列で音響イベントを検出（マルチパート解析なし）
+    
+    Args:
+        request: 音声データをそのままボディに持つリクエスト
+        segment_duration: セグメントの長さ（秒）デフォルト: 10.0
+        overlap: オーバーラップ（0-1）デフォルト: 0.0
+        top_k: 各時刻で返すイベント数 デフォルト: 3
+        filename: レスポンスに含めるファイル名
+    
+    Returns:
+        時系列分析結果
+    """
+    if ast_inference.model is None or ast_inference.feature_extractor is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    try:
+        # ボディをストリーミングで受信
+        print(f"Processing timeline for: {filename}")
+        buffer = io.BytesIO()
+        async for chunk in request.stream():
+            buffer.write(chunk)
+        buffer.seek(0)
         
-        print(f"✅ Timeline analysis complete: {len(result['timeline'])} segments")
-        return JSONResponse(content=result)
+        # 音声データを読み込む
+        audio_data, sample_rate = sf.read(buffer, dtype='float32')
+        print(f"Audio loaded: {len(audio_data)/sample_rate:.2f} seconds, {sample_rate} Hz")
+        
+        return build_timeline_response(
+            audio_data, sample_rate, filename,
+            segment_duration, overlap, top_k
+        )
         
     except Exception as e:
         print(f"❌ Error: {str(e)}")
@@ -315,34 +266,24 @@ async def analyze_sound(
     """
     音声ファイル全体から音響イベントを検出（従来版）
     """
-    if model is None or feature_extractor is None:
+    if ast_inference.model is None or ast_inference.feature_extractor is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
         content = await file.read()
-        audio_data, sample_rate = sf.read(io.BytesIO(content))
-        
-        # モノラル変換
-        if len(audio_data.shape) > 1:
-            audio_data = np.mean(audio_data, axis=1)
-        
-        # リサンプリング
-        if sample_rate != 16000:
-            audio_data = librosa.resample(audio_data, orig_sr=sample_rate, target_sr=16000)
+        audio_data, sample_rate = sf.read(io.BytesIO(content), dtype='float32')
         
-        # 正規化
-        max_val = np.max(np.abs(audio_data))
-        if max_val > 0:
-            audio_data = audio_data / max_val
+        # モノラル化・16kHzへのリサンプリング・正規化
+        audio_data = process_audio(audio_data, sample_rate)
         
         # 全体を分析
-        predictions = predict_segment(audio_data, top_k=top_k)
+        predictions = predict_segments([audio_data], top_k=top_k)[0]
         
         return JSONResponse(content={
             "predictions": predictions,
             "audio_info": {
                 "filename": file.filename,
-                "duration_seconds": round(len(audio_data) / 16000, 2),
+                "duration_seconds": round(len(audio_data) / TARGET_SR, 2),
                 "sample_rate": sample_rate
             }
         })
@@ -4,19 +4,105 @@ AST API Supabase統合版のテストスクリプト
 fetch-and-process-pathsエンドポイントのテスト
 """
 
+import argparse
+import asyncio
+import atexit
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+import time
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 import json
+import orjson
 from datetime import datetime, timedelta
 
+# 非同期の負荷テストはuvloopがあれば使う（uvicorn[standard]と一緒にインストールされる）
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # APIのベースURL
 BASE_URL = "http://localhost:8017"
 
+# 負荷テストで1リクエストにまとめるファイル数（リクエスト数を減らし、サーバー側でまとめて処理させる）
+FILE_PATHS_PER_REQUEST = 32
+
+# 負荷テストの対象ファイル（カンマ区切りで指定、--load-test-pathsでも指定できる）
+# 存在しないパスはaudio_filesのステータスがerrorに更新されるため既定値は持たず、
+# 未指定の場合は負荷テストを行わない
+# （同じパスを繰り返すと、サーバーは同じダウンロードと推論を繰り返し、保存は1行にまとめられるため
+#   実際の負荷にならないので、重複しないパスを指定する）
+LOAD_TEST_FILE_PATHS = os.getenv("LOAD_TEST_FILE_PATHS", "")
+
+# JSONボディを送るときのヘッダー（orjsonで事前にシリアライズしたbytesを送る）
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# エラーレスポンスのボディは先頭のこのバイト数だけ読み込む
+MAX_ERROR_BODY_BYTES = 4096
+
+# (接続タイムアウト, 読み込みタイムアウト)
+# 接続タイムアウトはTCPの再送間隔（3秒）の倍数から少しずらす
+HEALTH_TIMEOUT = (3.05, 10)
+PROCESS_TIMEOUT = (3.05, 57)
+DUMMY_PROCESS_TIMEOUT = (3.05, 27)
+
+# 半開きの接続を早く検出するためのTCP keepalive設定（対応OSのみ）
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    KEEPALIVE_SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+    ]
+
+class KeepAliveAdapter(HTTPAdapter):
+    """TCP keepaliveを有効にした接続プールを作るHTTPAdapter"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+# 全テストで接続を使い回すセッション（keep-aliveでTCP接続の確立を1回にする）
+SESSION = requests.Session()
+SESSION.mount("http://", KeepAliveAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+SESSION.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
+atexit.register(SESSION.close)
+
+def read_body(response: requests.Response) -> bytes:
+    """
+    レスポンスのボディを1回だけ読み込む（stream=Trueで受信したレスポンス用）
+    
+    Args:
+        response: stream=Trueで受信したレスポンス
+    
+    Returns:
+        成功時はボディ全体、失敗時は先頭MAX_ERROR_BODY_BYTESバイト
+    """
+    if response.status_code == 200:
+        return response.content
+    
+    # 大きなエラーレスポンスを全て読み込まないよう上限付きで読み、残りは接続ごと破棄
+    try:
+        return response.raw.read(MAX_ERROR_BODY_BYTES, decode_content=True)
+    finally:
+        response.close()
+
 def test_health():
     """ヘルスチェック"""
     print("📋 ヘルスチェック...")
-    response = requests.get(f"{BASE_URL}/health")
+    response = SESSION.get(f"{BASE_URL}/health", timeout=HEALTH_TIMEOUT)
     if response.status_code == 200:
-        data = response.json()
+        data = orjson.loads(response.content)
         print(f"✅ ヘルスチェック成功")
         print(f"   - モデル: {'ロード済み' if data['model_loaded'] else '未ロード'}")
         print(f"   - Supabase: {'接続済み' if data['supabase_connected'] else '未接続'}")
@@ -26,9 +112,9 @@ def test_health():
         print(f"❌ ヘルスチェック失敗: {response.status_code}")
         return False
 
-def test_fetch_and_process_paths():
-    """fetch-and-process-pathsエンドポイントのテスト"""
-    print("\n📋 fetch-and-process-pathsエンドポイントのテスト...")
+def test_fetch_and_process_paths(log=print):
+    """fetch-and-process-pathsエンドポイントのテスト（出力はlogに渡す）"""
+    log("\n📋 fetch-and-process-pathsエンドポイントのテスト...")
     
     # テスト用のfile_paths（実際のファイルパスに置き換える必要があります）
     # 形式: files/{device_id}/{date}/{time_block}/audio.wav
@@ -42,58 +128,151 @@ def test_fetch_and_process_paths():
         "threshold": 0.1,
         "top_k": 5,
         "analyze_timeline": True,
-        "segment_duration": 1.0,
-        "overlap": 0.5
+        "segment_duration": 10.0,
+        "overlap": 0.0
     }
     
-    print(f"📤 リクエスト送信中...")
-    print(f"   - ファイル数: {len(test_file_paths)}")
-    print(f"   - しきい値: {request_data['threshold']}")
-    print(f"   - タイムライン分析: {'有効' if request_data['analyze_timeline'] else '無効'}")
+    log(f"📤 リクエスト送信中...")
+    log(f"   - ファイル数: {len(test_file_paths)}")
+    log(f"   - しきい値: {request_data['threshold']}")
+    log(f"   - タイムライン分析: {'有効' if request_data['analyze_timeline'] else '無効'}")
+    
+    # リクエストボディは1回だけシリアライズする
+    payload = orjson.dumps(request_data)
     
     try:
-        response = requests.post(
+        # 計測前にセッションの接続を確立しておく（TCP接続の時間を計測から除外）
+        SESSION.get(f"{BASE_URL}/health", timeout=HEALTH_TIMEOUT)
+        
+        start_time = time.perf_counter()
+        response = SESSION.post(
             f"{BASE_URL}/fetch-and-process-paths",
-            json=request_data,
-            timeout=60  # タイムアウトを60秒に設定
+            data=payload,
+            headers=JSON_HEADERS,
+            timeout=PROCESS_TIMEOUT,  # 接続3秒 + 読み込み57秒
+            stream=True
         )
+        raw = read_body(response)
+        elapsed = time.perf_counter() - start_time
         
         if response.status_code == 200:
-            data = response.json()
-            print(f"✅ 処理成功")
-            print(f"\n📊 処理結果サマリー:")
-            print(f"   - ステータス: {data['status']}")
-            print(f"   - 総ファイル数: {data['summary']['total_files']}")
-            print(f"   - 処理成功: {data['summary']['processed']}")
-            print(f"   - エラー: {data['summary']['errors']}")
-            print(f"   - 実行時間: {data['execution_time_seconds']}秒")
+            data = orjson.loads(raw)
+            log(f"✅ 処理成功（応答時間: {elapsed:.1f}秒）")
+            log(f"\n📊 処理結果サマリー:")
+            log(f"   - ステータス: {data['status']}")
+            log(f"   - 総ファイル数: {data['summary']['total_files']}")
+            log(f"   - 処理成功: {data['summary']['processed']}")
+            log(f"   - エラー: {data['summary']['errors']}")
+            log(f"   - 実行時間: {data['execution_time_seconds']}秒")
             
             if data['processed_files']:
-                print(f"\n✅ 処理成功ファイル:")
+                log(f"\n✅ 処理成功ファイル:")
                 for file in data['processed_files']:
-                    print(f"   - {file}")
+                    log(f"   - {file}")
             
             if data['error_files']:
-                print(f"\n❌ エラーファイル:")
+                log(f"\n❌ エラーファイル:")
                 for error in data['error_files']:
-                    print(f"   - {error['file_path']}: {error['error']}")
+                    log(f"   - {error['file_path']}: {error['error']}")
             
             return True
         else:
-            print(f"❌ 処理失敗: {response.status_code}")
-            print(f"   エラー詳細: {response.text}")
+            log(f"❌ 処理失敗: {response.status_code}")
+            log(f"   エラー詳細: {raw.decode('utf-8', errors='replace')}")
             return False
             
     except requests.exceptions.Timeout:
-        print(f"❌ タイムアウト: 処理に60秒以上かかりました")
+        log(f"❌ タイムアウト: 処理に60秒以上かかりました")
         return False
     except Exception as e:
-        print(f"❌ エラー: {str(e)}")
+        log(f"❌ エラー: {str(e)}")
         return False
 
-def test_with_dummy_path():
-    """ダミーパスでのテスト（エラーハンドリング確認用）"""
-    print("\n📋 エラーハンドリングテスト（存在しないファイル）...")
+async def run_batch(paths_chunks, request_options):
+    """
+    複数のfetch-and-process-pathsリクエストを並行して送信
+    
+    Args:
+        paths_chunks: リクエストごとのfile_pathsのリスト
+        request_options: file_paths以外のリクエストパラメータ
+    
+    Returns:
+        レスポンス（または例外）のリスト
+    """
+    # uvicornはHTTP/1.1のみなので、HTTP/2の多重化ではなく接続プールで並行させる
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=64, keepalive_expiry=30)
+    transport = httpx.AsyncHTTPTransport(retries=1, limits=limits)
+    
+    # 送信前に全リクエストのボディをorjsonでシリアライズしておく
+    payloads = [orjson.dumps({"file_paths": chunk, **request_options}) for chunk in paths_chunks]
+    
+    async with httpx.AsyncClient(transport=transport, timeout=300) as client:
+        return await asyncio.gather(
+            *(client.post(
+                f"{BASE_URL}/fetch-and-process-paths",
+                content=payload,
+                headers=JSON_HEADERS
+            ) for payload in payloads),
+            return_exceptions=True
+        )
+
+def run_concurrent_requests(all_paths):
+    """
+    複数ファイルをまとめたリクエストを同時に送ってサーバー全体のスループットを確認
+    
+    注意: 本番と同じ処理を行うため、対象ファイルの結果が実際のSupabaseの
+    behavior_yamnetテーブルに保存され、audio_filesのbehavior_features_statusも更新されます
+    
+    Args:
+        all_paths: 対象のファイルパスのリスト（重複しないパスを指定する）
+    """
+    num_files = len(all_paths)
+    
+    # FILE_PATHS_PER_REQUEST件ずつ1リクエストにまとめる
+    paths_chunks = [
+        all_paths[i:i + FILE_PATHS_PER_REQUEST]
+        for i in range(0, len(all_paths), FILE_PATHS_PER_REQUEST)
+    ]
+    num_requests = len(paths_chunks)
+    print(f"\n📋 同時リクエストのテスト（{num_files}ファイル / {num_requests}リクエスト）...")
+    print(f"⚠️ 結果はSupabaseのbehavior_yamnetテーブルに保存され、audio_filesのステータスも更新されます")
+    request_options = {
+        "threshold": 0.1,
+        "top_k": 5,
+        "analyze_timeline": True,
+        "segment_duration": 10.0,
+        "overlap": 0.0
+    }
+    
+    start_time = time.perf_counter()
+    # uvloopはこの負荷テストのループだけで使う（プロセス全体のイベントループポリシーは変えない）
+    # （uvloop.runがない0.18未満のuvloopでは標準のイベントループを使う）
+    run = getattr(uvloop, "run", asyncio.run)
+    responses = run(run_batch(paths_chunks, request_options))
+    elapsed = time.perf_counter() - start_time
+    
+    success_count = 0
+    processed_count = 0
+    for i, response in enumerate(responses, 1):
+        if isinstance(response, Exception):
+            print(f"   ❌ リクエスト{i}: {type(response).__name__}: {str(response)}")
+        elif response.status_code == 200:
+            success_count += 1
+            # 存在しないファイルなどはエラーとして返るので、実際に処理できたファイル数を数える
+            processed_count += orjson.loads(response.content)["summary"]["processed"]
+        else:
+            print(f"   ❌ リクエスト{i}: ステータスコード {response.status_code}")
+    
+    print(f"📊 {success_count}/{num_requests}件成功")
+    print(f"   - 処理できたファイル: {processed_count}/{num_files}件")
+    print(f"   - 合計時間: {elapsed:.1f}秒")
+    print(f"   - スループット: {processed_count / elapsed:.2f}ファイル/秒")
+    
+    return success_count == num_requests
+
+def test_with_dummy_path(log=print):
+    """ダミーパスでのテスト（エラーハンドリング確認用、出力はlogに渡す）"""
+    log("\n📋 エラーハンドリングテスト（存在しないファイル）...")
     
     dummy_paths = [
         "files/test-device/2025-01-01/00-00/dummy.wav"
@@ -106,34 +285,60 @@ def test_with_dummy_path():
     }
     
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{BASE_URL}/fetch-and-process-paths",
-            json=request_data,
-            timeout=30
+            data=orjson.dumps(request_data),
+            headers=JSON_HEADERS,
+            timeout=DUMMY_PROCESS_TIMEOUT,
+            stream=True
         )
+        raw = read_body(response)
         
         if response.status_code == 200:
-            data = response.json()
-            print(f"📊 レスポンス受信:")
-            print(f"   - ステータス: {data['status']}")
-            print(f"   - エラー数: {data['summary']['errors']}")
+            data = orjson.loads(raw)
+            log(f"📊 レスポンス受信:")
+            log(f"   - ステータス: {data['status']}")
+            log(f"   - エラー数: {data['summary']['errors']}")
             
             if data['error_files']:
-                print(f"✅ エラーハンドリング正常:")
+                log(f"✅ エラーハンドリング正常:")
                 for error in data['error_files']:
-                    print(f"   - {error['file_path']}: {error['error']}")
+                    log(f"   - {error['file_path']}: {error['error']}")
             
             return True
         else:
-            print(f"❌ 予期しないステータスコード: {response.status_code}")
+            log(f"❌ 予期しないステータスコード: {response.status_code}")
+            log(f"   エラー詳細: {raw.decode('utf-8', errors='replace')}")
             return False
             
     except Exception as e:
-        print(f"❌ エラー: {str(e)}")
+        log(f"❌ エラー: {str(e)}")
         return False
 
-def main():
-    """メインテスト実行"""
+def run_section(title: str, test_func):
+    """
+    テストを実行し、出力を行のリストに溜めて返す（並行実行しても出力が混ざらない）
+    
+    Args:
+        title: 見出し
+        test_func: 出力先の関数をlogとして受け取るテスト関数
+    
+    Returns:
+        (テスト結果, 見出しを含む出力行のリスト)
+    """
+    lines = ["\n" + "=" * 60, title, "=" * 60]
+    result = test_func(log=lines.append)
+    return result, lines
+
+def main(load_test: bool = False, load_test_paths=()):
+    """
+    メインテスト実行
+    
+    Args:
+        load_test: 同時リクエストの負荷テストも実行するか
+            （対象ファイルの結果がSupabaseに保存されるため、明示的に指定した場合のみ）
+        load_test_paths: 負荷テストの対象ファイルパスのリスト（空なら負荷テストは行わない）
+    """
     print("=" * 60)
     print("AST API Supabase統合版 テスト開始")
     print("=" * 60)
@@ -145,21 +350,43 @@ def main():
         print("  python3 main_supabase.py")
         return
     
-    # メインエンドポイントのテスト
-    print("\n" + "=" * 60)
-    print("1. 正常なファイルパスでのテスト")
-    print("=" * 60)
-    test_fetch_and_process_paths()
+    # メインエンドポイントのテストとエラーハンドリングテストは対象ファイルが別なので並行して実行
+    # （SESSIONはスレッド間で共有、出力はテストごとにまとめて表示）
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(run_section, "1. 正常なファイルパスでのテスト",
+                            test_fetch_and_process_paths),
+            executor.submit(run_section, "2. エラーハンドリングテスト",
+                            test_with_dummy_path)
+        ]
+        # 各テストの出力は終了後にまとめて表示
+        for future in futures:
+            _, lines = future.result()
+            print("\n".join(lines))
     
-    # エラーハンドリングテスト
-    print("\n" + "=" * 60)
-    print("2. エラーハンドリングテスト")
-    print("=" * 60)
-    test_with_dummy_path()
+    # 並行リクエストのテスト（--load-test指定時のみ）
+    if load_test:
+        print("\n" + "=" * 60)
+        print("3. 同時リクエストのテスト")
+        print("=" * 60)
+        if load_test_paths:
+            run_concurrent_requests(list(load_test_paths))
+        else:
+            print("⚠️ 対象ファイルが指定されていないため負荷テストをスキップします")
+            print("   LOAD_TEST_FILE_PATHS または --load-test-paths で実在するファイルパスを指定してください")
     
     print("\n" + "=" * 60)
     print("テスト完了")
     print("=" * 60)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="AST API Supabase統合版のテスト")
+    parser.add_argument("--load-test", action="store_true",
+                        help="同時リクエストの負荷テストも実行する（結果はSupabaseに保存される）")
+    parser.add_argument("--load-test-paths", default=LOAD_TEST_FILE_PATHS,
+                        help="負荷テストの対象ファイルパス（カンマ区切り、既定: 環境変数LOAD_TEST_FILE_PATHS）")
+    args = parser.parse_args()
+    main(
+        load_test=args.load_test,
+        load_test_paths=[path for path in args.load_test_paths.split(",") if path]
+    )
\ No newline at end of file
@@ -4,28 +4,299 @@ AST (Audio Spectrogram Transformer) モデルの動作確認スクリプト
 MIT/ast-finetuned-audioset-10-10-0.4593 モデルをテスト
 """
 
+import argparse
+import functools
+import os
+import time
+
 import torch
 from transformers import AutoFeatureExtractor, ASTForAudioClassification
 import numpy as np
 
-def test_model():
-    """モデルの基本動作を確認"""
+# サーバーと同じ特徴抽出で計測する
+from ast_inference import extract_features
+
+# 推論のみなので勾配計算を無効化（feature extractor内のテンソル生成も含む）
+torch.set_grad_enabled(False)
+
+# ダミー音声生成用の乱数生成器（再現性のためシード固定）
+RNG = np.random.default_rng(0)
+
+@functools.cache
+def _load(model_name: str):
+    """
+    feature extractorとモデルを読み込む（同じプロセス内の2回目以降はキャッシュを返す）
+    
+    Args:
+        model_name: Hugging FaceのモデルID
+    
+    Returns:
+        (feature_extractor, model) のタプル
+    """
+    feature_extractor = AutoFeatureExtractor.from_pretrained(model_name)
+    model = ASTForAudioClassification.from_pretrained(model_name)
+    return feature_extractor, model
+
+def bench_onnx(model, inputs: dict, reference_logits: torch.Tensor,
+              warmup: int = 5, steps: int = 200, onnx_path: str = "ast.onnx") -> bool:
+    """
+    ONNX Runtime（利用可能ならTensorRT/CUDA）で推論し、PyTorchとの差と推論時間を確認
+    
+    Args:
+        model: ASTモデル
+        inputs: feature extractorの出力（input_values）
+        reference_logits: float32 eagerモデルでの推論結果（比較用）
+        warmup: 計測前に実行する推論回数
+        steps: 計測する推論回数
+        onnx_path: エクスポート先のファイルパス（既に存在すれば再利用）
+    
+    Returns:
+        成功したかどうか
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        print("⚠️ onnxruntimeがインストールされていないためスキップします（pip install onnxruntime-gpu）")
+        return False
+    
+    input_values = inputs["input_values"].float()
+    
+    # 1回だけエクスポートして以降は再利用
+    if not os.path.exists(onnx_path):
+        print(f"   - ONNXにエクスポート中: {onnx_path}")
+        torch.onnx.export(
+            model,
+            (input_values,),
+            onnx_path,
+            opset_version=17,
+            input_names=["input_values"],
+            output_names=["logits"],
+            dynamic_axes={"input_values": {0: "B"}, "logits": {0: "B"}}
+        )
+    
+    # 利用可能な実行プロバイダを優先順に選択
+    available = ort.get_available_providers()
+    providers = []
+    if "TensorrtExecutionProvider" in available:
+        providers.append(("TensorrtExecutionProvider", {"device_id": 0, "trt_fp16_enable": True}))
+    if "CUDAExecutionProvider" in available:
+        providers.append(("CUDAExecutionProvider", {"device_id": 0}))
+    providers.append("CPUExecutionProvider")
+    
+    session = ort.InferenceSession(onnx_path, providers=providers)
+    feed = {"input_values": input_values.cpu().numpy()}
+    print(f"   - 実行プロバイダ: {session.get_providers()[0]}")
+    
+    for _ in range(warmup):
+        session.run(None, feed)
+    
+    start_time = time.perf_counter()
+    for _ in range(steps):
+        session.run(None, feed)
+    elapsed = time.perf_counter() - start_time
+    
+    # 比較用の出力は計測外で1回だけ取得（steps=0でも比較できる）
+    logits = session.run(None, feed)[0]
+    max_diff = np.abs(logits - reference_logits.float().cpu().numpy()).max()
+    print(f"✅ ONNX Runtimeでの推論に成功しました")
+    if steps > 0:
+        print(f"   - 平均推論時間: {elapsed / steps * 1000:.1f}ms/バッチ")
+    print(f"   - PyTorch（float32 eager）との最大誤差: {max_diff:.4f}")
+    
+    return True
+
+def bench_cuda_graph(model, inputs: dict, reference_logits: torch.Tensor,
+                    autocast_dtype: torch.dtype, autocast_enabled: bool,
+                    warmup: int = 10, steps: int = 200) -> bool:
+    """
+    固定形状の推論をCUDA Graphにキャプチャし、replayで推論時間を確認
+    
+    Args:
+        model: GPU上のASTモデル
+        inputs: GPU上のfeature extractorの出力（input_values）
+        reference_logits: float32 eagerモデルでの推論結果（比較用）
+        autocast_dtype: 自動混合精度のデータ型
+        autocast_enabled: 自動混合精度を有効にするか
+        warmup: キャプチャ前に実行する推論回数
+        steps: 計測する推論回数
+    
+    Returns:
+        成功したかどうか
+    """
+    if not torch.cuda.is_available():
+        print("⚠️ GPUがないためスキップします")
+        return False
+    
+    # グラフは入力・出力のメモリアドレスを固定して記録するため、静的な入力バッファを用意
+    static_input = torch.empty_like(inputs["input_values"], device="cuda")
+    static_input.copy_(inputs["input_values"])
+    
+    # キャプチャ中はautocastのキャッシュを使えないため無効化
+    autocast = lambda: torch.autocast(
+        device_type="cuda", dtype=autocast_dtype, enabled=autocast_enabled, cache_enabled=False
+    )
+    
+    with torch.inference_mode():
+        # 別ストリームでウォームアップしてからキャプチャ
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream), autocast():
+            for _ in range(warmup):
+                model(input_values=static_input)
+        torch.cuda.current_stream().wait_stream(side_stream)
+        
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph), autocast():
+            static_output = model(input_values=static_input).logits
+        
+        # 新しい入力を静的バッファにコピーしてreplayする
+        torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        for _ in range(steps):
+            static_input.copy_(inputs["input_values"])
+            graph.replay()
+        torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start_time
+        
+        # 比較用の出力は計測外で1回replayして取得（steps=0でもキャプチャ時の未計算の値を読まない）
+        static_input.copy_(inputs["input_values"])
+        graph.replay()
+        logits = static_output.clone()
+    
+    max_diff = (logits.float() - reference_logits.float()).abs().max().item()
+    print(f"✅ CUDA Graphでの推論に成功しました")
+    if steps > 0:
+        print(f"   - 平均推論時間: {elapsed / steps * 1000:.1f}ms/バッチ")
+    print(f"   - float32 eagerとの最大誤差（混合精度の誤差を含む）: {max_diff:.4f}")
+    
+    return True
+
+def infer_via_server(server_url: str, dummy_audio: np.ndarray, sample_rate: int,
+                warmup: int = 10, steps: int = 200) -> bool:
+    """
+    起動済みのAPIサーバー（main.py）の/inferにPCMを送って推論する（モデルのロードを省略）
+    
+    Args:
+        server_url: APIサーバーのURL
+        dummy_audio: [B, num_samples] のfloat32音声
+        sample_rate: サンプリングレート
+        warmup: 計測前に送るリクエスト数
+        steps: 計測するリクエスト数
+    
+    Returns:
+        成功したかどうか
+    """
+    import requests
+    
+    session = requests.Session()
+    headers = {"Content-Type": "application/octet-stream"}
+    params = {"sample_rate": sample_rate, "top_k": 5}
+    payloads = [window.tobytes() for window in dummy_audio]
+    
+    def infer(payload: bytes) -> dict:
+        response = session.post(f"{server_url}/infer", data=payload, headers=headers,
+                                params=params, timeout=60)
+        response.raise_for_status()
+        return response.json()
+    
+    for i in range(warmup):
+        infer(payloads[i % len(payloads)])
+    
+    start_time = time.perf_counter()
+    for i in range(steps):
+        infer(payloads[i % len(payloads)])
+    elapsed = time.perf_counter() - start_time
+    
+    # 表示用の結果は計測外で1回だけ取得（steps=0でも表示できる）
+    result = infer(payloads[0])
+    
+    print(f"✅ サーバーでの推論に成功しました")
+    if steps > 0:
+        print(f"   - 平均応答時間: {elapsed / steps * 1000:.1f}ms/ウィンドウ")
+    print(f"\n   推論結果（上位5件）:")
+    for i, prediction in enumerate(result["predictions"], 1):
+        print(f"   {i}. {prediction['label']}, Score: {prediction['score']:.4f}")
+    
+    return True
+
+def test_model(batch_size: int = 8, warmup: int = 10, steps: int = 200, onnx: bool = False,
+               cuda_graph: bool = False, compile_model: bool = False, server_url: str = None):
+    """
+    モデルの基本動作を確認（複数ウィンドウをまとめてバッチ推論）
+    
+    Args:
+        batch_size: 1回の推論でまとめて処理する音声ウィンドウ数
+        warmup: 計測前に実行する推論回数（計測しない）
+        steps: 計測する推論回数（1以上）
+        onnx: ONNX Runtimeでの推論も実行するか
+        cuda_graph: CUDA Graphでの推論も実行するか（GPUのみ）
+        compile_model: torch.compileでコンパイルしたモデルで推論するか
+        server_url: 指定した場合はモデルをロードせず、起動済みサーバーの/inferで推論する
+    """
     print("=" * 50)
     print("AST Model Test Script")
     print("=" * 50)
     
+    if server_url:
+        # ロード済みのサーバーを使い回す（このプロセスではモデルをロードしない）
+        print(f"\n1. 起動済みサーバーで推論: {server_url}")
+        try:
+            sample_rate = 16000
+            dummy_audio = np.empty((batch_size, sample_rate), dtype=np.float32)
+            RNG.standard_normal(dtype=np.float32, out=dummy_audio)
+            return infer_via_server(server_url, dummy_audio, sample_rate, warmup=warmup, steps=steps)
+        except Exception as e:
+            print(f"\n❌ エラーが発生しました: {str(e)}")
+            return False
+    
+    # 複数のテストを同時に実行してもCPUスレッドを奪い合わないよう半分に制限
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+    
     # モデル名
     model_name = "MIT/ast-finetuned-audioset-10-10-0.4593"
     print(f"\n1. モデルをダウンロード中: {model_name}")
     
     try:
         # Feature ExtractorとModelの読み込み
-        feature_extractor = AutoFeatureExtractor.from_pretrained(model_name)
-        model = ASTForAudioClassification.from_pretrained(model_name)
+        feature_extractor, model = _load(model_name)
+        
+        # GPUがあればGPUで実行
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model = model.to(device).eval()
         print("✅ モデルのダウンロードに成功しました")
         
+        # 自動混合精度の設定（GPUはfloat16、AMX対応CPUはbfloat16）
+        amx_supported = getattr(torch.cpu, "_is_amx_tile_supported", lambda: False)()
+        autocast_dtype = torch.float16 if device == "cuda" else torch.bfloat16
+        autocast_enabled = device == "cuda" or amx_supported
+        
+        # ONNXエクスポートやCUDA Graphのキャプチャには量子化・コンパイル前のモデルを使う
+        eager_model = model
+        
+        # bfloat16非対応のCPUではLinear層をint8に動的量子化（main.pyと同じ）
+        # 動的量子化したLinearはtorch.compileで安定してコンパイルできないため、
+        # --compile指定時は量子化せずにfloatのモデルをコンパイルする
+        quantized = device == "cpu" and not amx_supported and not compile_model
+        if quantized:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            dense = model.audio_spectrogram_transformer.encoder.layer[0].intermediate.dense
+            print(f"   - int8動的量子化: {type(dense).__module__}.{type(dense).__name__}")
+        
+        if compile_model:
+            # TF32/bf16のTensor Coreを使った行列演算を許可
+            torch.set_float32_matmul_precision("high")
+            # GPUはCUDA Graphを使うreduce-overhead、CPUはカーネルを自動チューニングするmax-autotune
+            mode = "reduce-overhead" if device == "cuda" else "max-autotune"
+            model = torch.compile(model, mode=mode, fullgraph=False, dynamic=False)
+            print(f"   - torch.compile: mode={mode}（初回のウォームアップでコンパイル）")
+        
         # モデル情報の表示
         print(f"\n2. モデル情報:")
+        print(f"   - デバイス: {device}")
+        print(f"   - 混合精度: {autocast_dtype if autocast_enabled else '無効'}")
+        print(f"   - int8量子化: {'有効' if quantized else '無効'}")
         print(f"   - ラベル数: {model.config.num_labels}")
         print(f"   - サンプリングレート: {feature_extractor.sampling_rate} Hz")
         
@@ -35,40 +306,94 @@ def test_model():
         sample_rate = feature_extractor.sampling_rate
         num_samples = int(duration * sample_rate)
         
-        # ランダムノイズを生成（実際の音声の代わり）
-        dummy_audio = np.random.randn(num_samples).astype(np.float32)
+        # ランダムノイズを生成（実際の音声の代わり、float32のバッファに直接書き込む）
+        dummy_audio = np.empty((batch_size, num_samples), dtype=np.float32)
+        RNG.standard_normal(dtype=np.float32, out=dummy_audio)
         print(f"   - 音声長: {duration}秒")
         print(f"   - サンプル数: {num_samples}")
+        print(f"   - バッチサイズ: {batch_size}")
         
-        # 特徴抽出
+        # 特徴抽出（音声をデバイスに転送し、fbankをデバイス上で計算）
         print(f"\n4. 特徴抽出中...")
-        inputs = feature_extractor(
-            dummy_audio, 
+        waveforms = torch.from_numpy(dummy_audio)
+        if device == "cuda":
+            # ページロックメモリから専用ストリームで非同期にGPUへ転送
+            copy_stream = torch.cuda.Stream()
+            with torch.cuda.stream(copy_stream):
+                waveforms = waveforms.pin_memory().to(device, non_blocking=True)
+            torch.cuda.current_stream().wait_stream(copy_stream)
+        inputs = {"input_values": extract_features(feature_extractor, waveforms, device)}
+        print("✅ 特徴抽出に成功しました")
+        print(f"   - 入力形状: {tuple(inputs['input_values'].shape)}")
+        
+        # Hugging Faceのfeature extractor（CPU/NumPy）の出力と一致するか確認
+        reference_inputs = feature_extractor(
+            list(dummy_audio), 
             sampling_rate=sample_rate, 
             return_tensors="pt"
         )
-        print("✅ 特徴抽出に成功しました")
+        feature_diff = (inputs["input_values"].cpu() - reference_inputs["input_values"]).abs().max().item()
+        print(f"   - feature extractorとの最大誤差: {feature_diff:.2e}")
         
         # 推論実行
         print(f"\n5. 推論実行中...")
-        with torch.no_grad():
-            outputs = model(**inputs)
+        with torch.inference_mode(), torch.autocast(
+            device_type=device, dtype=autocast_dtype, enabled=autocast_enabled
+        ):
+            # ウォームアップ（初回のメモリ確保などを計測から除外）
+            for _ in range(warmup):
+                model(**inputs)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+            
+            # バッチ推論の時間を計測
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            for _ in range(steps):
+                outputs = model(**inputs)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start_time
             logits = outputs.logits
         print(f"✅ 推論に成功しました")
         print(f"   - 出力形状: {logits.shape}")
+        print(f"   - 平均推論時間: {elapsed / steps * 1000:.1f}ms/バッチ "
+              f"({elapsed / (steps * batch_size) * 1000:.1f}ms/ウィンドウ)")
         
-        # 上位5つのラベルを取得
-        probs = torch.nn.functional.softmax(logits, dim=-1)[0]
-        top5_probs, top5_indices = torch.topk(probs, 5)
+        # 上位5つのラベルを取得（先頭のウィンドウ、数値安定性のためfloat32で計算）
+        # Softmaxは単調なのでlogitsのまま上位5個を取得し、その5個だけを確率に変換
+        first_logits = logits[0].float()
+        top5_logits, top5_indices = torch.topk(first_logits, 5)
+        top5_probs = (top5_logits - torch.logsumexp(first_logits, dim=-1)).exp()
         
         print(f"\n6. 推論結果（上位5件）:")
         print("   注: これはランダムノイズに対する結果です")
-        for i, (prob, idx) in enumerate(zip(top5_probs, top5_indices), 1):
-            label_id = idx.item()
-            score = prob.item()
+        # 要素ごとの.item()を避け、まとめてPythonのリストに変換
+        for i, (score, label_id) in enumerate(zip(top5_probs.cpu().tolist(), top5_indices.cpu().tolist()), 1):
             # AudioSetのラベルIDを表示（実際のラベル名はid2labelマッピングが必要）
             print(f"   {i}. Label ID: {label_id:3d}, Score: {score:.4f}")
         
+        if onnx or cuda_graph:
+            # 比較の基準は量子化・混合精度・TF32なしのfloat32 eagerモデルの出力
+            # （計測したモデルの出力を基準にすると、量子化や混合精度の誤差が混ざる）
+            matmul_precision = torch.get_float32_matmul_precision()
+            torch.set_float32_matmul_precision("highest")
+            try:
+                with torch.inference_mode():
+                    reference_logits = eager_model(**inputs).logits.float()
+            finally:
+                torch.set_float32_matmul_precision(matmul_precision)
+        
+        if onnx:
+            print(f"\n7. ONNX Runtimeで推論中...")
+            bench_onnx(eager_model, inputs, reference_logits, warmup=warmup, steps=steps)
+        
+        if cuda_graph:
+            print(f"\n8. CUDA Graphで推論中...")
+            bench_cuda_graph(eager_model, inputs, reference_logits, autocast_dtype, autocast_enabled,
+                            warmup=warmup, steps=steps)
+        
         print("\n" + "=" * 50)
         print("✅ すべてのテストが成功しました！")
         print("=" * 50)
@@ -81,6 +406,25 @@ def test_model():
         traceback.print_exc()
         return False
 
+def positive_int(value: str) -> int:
+    """argparse用: 1以上の整数に変換する"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"1以上の整数を指定してください: {value}")
+    return number
+
 if __name__ == "__main__":
-    success = test_model()
+    parser = argparse.ArgumentParser(description="AST モデルの動作確認")
+    parser.add_argument("--batch", type=positive_int, default=8, help="1回の推論で処理するウィンドウ数（1以上）")
+    parser.add_argument("--warmup", type=int, default=10, help="計測前のウォームアップ回数")
+    parser.add_argument("--steps", type=positive_int, default=200, help="計測する推論回数（1以上）")
+    parser.add_argument("--onnx", action="store_true", help="ONNX Runtimeでの推論も実行する")
+    parser.add_argument("--cuda-graph", action="store_true", help="CUDA Graphでの推論も実行する（GPUのみ）")
+    parser.add_argument("--compile", action="store_true", help="torch.compileでコンパイルしたモデルで推論する")
+    parser.add_argument("--server", default=None,
+                        help="起動済みのAPIサーバーのURL（例: http://localhost:8017）。指定時はモデルをロードしない")
+    args = parser.parse_args()
+    
+    success = test_model(batch_size=args.batch, warmup=args.warmup, steps=args.steps, onnx=args.onnx,
+                         cuda_graph=args.cuda_graph, compile_model=args.compile, server_url=args.server)
     exit(0 if success else 1)
\ No newline at end of file